@@ -5,3 +5,4 @@ from collections import defaultdict
 
 SQL_ENGINES = {}
 SQL_DBS = defaultdict(dict)
+SQL_POOLS_METRICS = {}
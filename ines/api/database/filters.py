@@ -23,6 +23,7 @@ from ines.views.fields import FilterBy
 
 
 FILTER_BUILDER = []
+FILTER_BUILDER_CACHE = {}
 
 
 def filter_query_with_queries(queries, query=None, join_with='or'):
@@ -279,6 +280,17 @@ class DifferentFilter(Filter):
 
 
 def lookup_filter_builder(attribute):
+    # Builders can be registered later
+    key = (attribute, len(FILTER_BUILDER))
+    response = FILTER_BUILDER_CACHE.get(key)
+    if response is None:
+        if len(FILTER_BUILDER_CACHE) >= 4096:
+            FILTER_BUILDER_CACHE.clear()
+        response = FILTER_BUILDER_CACHE[key] = find_filter_builder(attribute)
+    return response
+
+
+def find_filter_builder(attribute):
     for builder in FILTER_BUILDER:
         matched_attribute = builder.parse(attribute)
         if matched_attribute:
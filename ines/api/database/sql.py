@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import partial
 from json import loads
+from os import getpid
+from threading import Lock
+from time import time
 
 from pyramid.decorator import reify
 from pyramid.settings import asbool
 from sqlalchemy import (
-    and_, BigInteger, Boolean, create_engine, Date, DateTime, Enum, func, Integer, MetaData, not_, or_, SmallInteger,
-    Unicode, UnicodeText)
+    and_, BigInteger, Boolean, Column, create_engine, Date, DateTime, Enum, func, inspect, Integer, MetaData, not_, or_,
+    select, SmallInteger, Unicode, UnicodeText)
 from sqlalchemy.dialects.mysql import TINYINT
-from sqlalchemy.exc import InternalError, OperationalError, ProgrammingError
+from sqlalchemy.exc import DisconnectionError, InternalError, OperationalError, ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.event import listen as sqlalchemy_listen
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import QueryableAttribute
 from sqlalchemy.orm.util import AliasedClass
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.schema import DDL
 from sqlalchemy.sql.selectable import Alias
 from sqlalchemy.util._collections import lightweight_named_tuple
@@ -24,6 +29,7 @@ from ines.api import BaseSessionManager
 from ines.api import BaseSession
 from ines.api.database import SQL_DBS
 from ines.api.database import SQL_ENGINES
+from ines.api.database import SQL_POOLS_METRICS
 from ines.api.database.filters import lookup_filter_builder
 from ines.api.database.postgresql import POSTGRESQL_LOWER_AND_CLEAR
 from ines.api.database.postgresql import postgresql_non_ascii_and_lower
@@ -31,12 +37,13 @@ from ines.api.database.postgresql import table_is_postgresql
 from ines.api.database.utils import (
     build_sql_relations, get_active_column, get_active_filter, get_api_first_method, get_api_all_method,
     get_column_table_relations, get_inactive_filter, get_recursively_active_filters, get_recursively_tables,
-    get_schema_table, get_table_backrefs, get_table_column, get_table_columns, maybe_table_schema,
+    get_schema_table, get_table_backrefs, get_table_column, get_table_columns, iter_query_stream, maybe_table_schema,
     replace_response_columns, SQLPagination, table_entry_as_dict)
 from ines.convert import maybe_date, maybe_datetime, maybe_integer, maybe_list, maybe_set, maybe_string
 from ines.exceptions import Error
 from ines.middlewares.repozetm import RepozeTMMiddleware
 from ines.path import get_object_on_path
+from ines.system import register_after_fork
 from ines.utils import NoneMaskObject, set_class_decorator, WrapperClass
 from ines.views.fields import OrderBy
 
@@ -66,6 +73,13 @@ SQLALCHEMY_CONVERT = {
     UnicodeText: maybe_string,
 }
 
+# Parsed columns, order by and relations, by table and attributes
+SQL_LOOKUPS_CACHE = OrderedDict()
+SQL_LOOKUPS_CACHE_LOCK = Lock()
+SQL_LOOKUPS_CACHE_SIZE = 2000
+SQL_LOOKUP_KEY_TYPES = (str, Column, QueryableAttribute)
+SQL_ROW_RESHAPERS = {}
+
 
 class BaseSQLSessionManager(BaseSessionManager):
     __api_name__ = 'database'
@@ -91,7 +105,15 @@ class BaseSQLSessionManager(BaseSessionManager):
             mysql_engine=self.settings.get('mysql_engine') or 'InnoDB',
             session_extension=session_extension,
             debug=asbool(self.settings.get('debug', False)),
-            json_strict_decoder=asbool(self.settings.get('json_strict_decoder', True)))
+            json_strict_decoder=asbool(self.settings.get('json_strict_decoder', True)),
+            pool_size=maybe_integer(self.settings.get('pool_size')),
+            pool_max_overflow=maybe_integer(self.settings.get('pool_max_overflow')),
+            pool_recycle=maybe_integer(self.settings.get('pool_recycle')),
+            pool_pre_ping=asbool(self.settings.get('pool_pre_ping', False)),
+            pool_timeout=maybe_integer(self.settings.get('pool_timeout')))
+
+    def get_pool_status(self):
+        return get_sql_pool_status(self.__database_name__)
 
 
 class BaseSQLSession(BaseSession):
@@ -123,6 +145,59 @@ class BaseSQLSession(BaseSession):
             .insert(values)
             .execute(autocommit=True))
 
+    def direct_insert_many(self, objs, unique_column=None, chunk_size=500):
+        objs = list(objs)
+        if not objs:
+            return []
+
+        table = get_schema_table(objs[0])
+        primary_key = list(table.primary_key.columns)[0]
+
+        # Column defaults are applied by SQLAlchemy for every row, rows only need the same keys
+        rows_by_keys = defaultdict(list)
+        for i, obj in enumerate(objs):
+            values = {}
+            for key in table.columns.keys():
+                value = getattr(obj, key, None)
+                if value is not None:
+                    values[key] = value
+            rows_by_keys[tuple(sorted(values.keys()))].append((i, values))
+
+        primary_keys = [None] * len(objs)
+        is_postgresql = table_is_postgresql(table)
+        for rows in rows_by_keys.values():
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                if is_postgresql:
+                    # One statement for all rows, returning new keys in the same order
+                    response = (
+                        table
+                        .insert()
+                        .values([values for i, values in chunk])
+                        .returning(primary_key)
+                        .execute())
+                    for (i, values), row in zip(chunk, response.fetchall()):
+                        primary_keys[i] = row[0]
+                else:
+                    table.insert().execute([values for i, values in chunk])
+
+        if not is_postgresql and unique_column is not None:
+            unique_column = table.columns[getattr(unique_column, 'key', unique_column)]
+            positions = defaultdict(list)
+            for i, obj in enumerate(objs):
+                positions[getattr(obj, unique_column.key)].append(i)
+
+            unique_values = list(positions.keys())
+            for start in range(0, len(unique_values), chunk_size):
+                for row in (
+                        select([primary_key, unique_column])
+                        .where(unique_column.in_(unique_values[start:start + chunk_size]))
+                        .execute()):
+                    for i in positions.get(row[1], []):
+                        primary_keys[i] = row[0]
+
+        return primary_keys
+
     def direct_delete(self, obj, query):
         return bool(
             get_schema_table(obj)
@@ -498,15 +573,20 @@ class SetSQLPosColumns(WrapperClass):
 
 
 class SetSQLPagination(WrapperClass):
-    def __init__(self, wrapped, count_column):
+    def __init__(self, wrapped, count_column, keyset=False, count_mode='exact'):
         super(SetSQLPagination, self).__init__(wrapped)
         self.count_column = count_column
+        self.keyset = keyset
+        self.count_mode = count_mode
 
     def __call__(self, *args, **kwargs):
         page = kwargs.pop('page', None)
         limit_per_page = kwargs.pop('limit_per_page', None)
         return_query = kwargs.pop('return_query', False)
         only_one = kwargs.pop('only_one', False)
+        stream = kwargs.pop('stream', False)
+        cursor = kwargs.pop('cursor', None)
+        count_mode = kwargs.pop('count_mode', self.count_mode)
         return_pos_columns_index = kwargs.get('return_pos_columns_index', False)
 
         if return_pos_columns_index:
@@ -518,34 +598,37 @@ class SetSQLPagination(WrapperClass):
             response = query
         elif only_one:
             response = query.first()
-        elif page is not None:
-            response = SQLPagination(query, page, limit_per_page or 20, count_column=self.count_column)
+        elif page is not None or cursor:
+            response = SQLPagination(
+                query,
+                page,
+                limit_per_page or 20,
+                count_column=self.count_column,
+                cursor=cursor,
+                keyset=self.keyset,
+                count_mode=count_mode,
+                stream=stream)
+            if response.is_stream:
+                if flat_positions:
+                    response.reshape_rows = partial(iter_reshaped_rows, flat_positions=flat_positions)
+                flat_positions = None
+        elif stream:
+            # Rows are fetched and reshaped while iterating
+            if limit_per_page:
+                query = query.slice(0, limit_per_page)
+            response = iter_reshaped_rows(iter_query_stream(query, stream is True and 1000 or stream), flat_positions)
+            flat_positions = None
         elif limit_per_page:
             response = query.slice(0, limit_per_page).all()
         else:
             response = query.all()
 
-        if response and not return_query:
+        if response and flat_positions and not return_query:
             if only_one:
-                response = [response]
-
-            named_tuples = {}
-            fields = list(response[0]._real_fields)
-            for name, start, end in reversed(flat_positions):
-                named_tuples[name] = lightweight_named_tuple('result', fields[start:end])
-                fields[start:end] = [name]
-
-            named_tuple = lightweight_named_tuple('result', fields)
-
-            for i, value in enumerate(response):
-                new_value = list(value)
-                for name, start, end in reversed(flat_positions):
-                    child_value = named_tuples[name](new_value[start:end])
-                    new_value[start:end] = [child_value.id is not None and child_value or None]
-                response[i] = named_tuple(new_value)
-
-            if only_one:
-                response = response[0]
+                response = make_row_reshaper(response._real_fields, flat_positions)(response)
+            else:
+                reshape_row = make_row_reshaper(response[0]._real_fields, flat_positions)
+                response[:] = [reshape_row(row) for row in response]
 
         if return_pos_columns_index:
             return response, pos_columns_index
@@ -567,15 +650,24 @@ class ParseSQLOrm(WrapperClass):
         group_by = filters.pop('group_by', None)
         return_pos_columns_index = filters.pop('return_pos_columns_index', False)
 
-        columns, related_tables, pos_columns_index, flat_positions = lookup_sql_columns(
-            table=self.orm_table,
-            attributes=attributes,
-            active=kwargs['active'])
+        # Same attributes, order and relations on every call, only filters values change
+        columns, related_tables, pos_columns_index, flat_positions = cache_sql_lookup(
+            make_sql_lookup_key('columns', self.orm_table, attributes, kwargs['active']),
+            lookup_sql_columns,
+            self.orm_table, attributes, kwargs['active'])
+        columns = list(columns)
+        related_tables = set(related_tables)
+        pos_columns_index = dict(pos_columns_index)
+        flat_positions = list(flat_positions)
 
         sa_filters, filters_related_tables = lookup_sql_filters(self.orm_table, filters)
         related_tables.update(filters_related_tables)
 
-        sa_order_by, order_by_related_tables = lookup_sql_order_by(self.orm_table, order_by, kwargs['active'])
+        sa_order_by, order_by_related_tables = cache_sql_lookup(
+            make_sql_lookup_key('order_by', self.orm_table, order_by, kwargs['active']),
+            lookup_sql_order_by,
+            self.orm_table, order_by, kwargs['active'])
+        sa_order_by = list(sa_order_by)
         related_tables.update(order_by_related_tables)
 
         # Build query
@@ -584,7 +676,11 @@ class ParseSQLOrm(WrapperClass):
         # Set relations
         related_tables.remove(self.orm_table.__table__)
         if related_tables:
-            related_filters, outer_joins = build_sql_relations(self.orm_table, related_tables)
+            related_filters, outer_joins, missing_tables = cache_sql_lookup(
+                ('relations', self.orm_table, frozenset(related_tables)),
+                lookup_sql_relations,
+                self.orm_table, related_tables)
+            related_tables = set(missing_tables)
             if related_tables:
                 raise ValueError(
                     'Cant find relations for tables %s on table %s'
@@ -618,8 +714,6 @@ class ParseSQLOrm(WrapperClass):
             pos_columns_index=pos_columns_index,
             kwargs=kwargs)
 
-        print(query)
-
         if return_pos_columns_index:
             return query, flat_positions, pos_columns_index
         else:
@@ -1278,6 +1372,88 @@ def lookup_sql_order_by(table, attributes, active):
 
 
 
+def lookup_sql_relations(table, related_tables):
+    # Cached and shared by every call, keep it immutable
+    missing_tables = set(related_tables)
+    related_filters, outer_joins = build_sql_relations(table, missing_tables)
+    return tuple(related_filters), tuple(outer_joins), frozenset(missing_tables)
+
+
+def make_sql_lookup_key(name, table, values, active):
+    key = [name, table, active]
+    for value in maybe_list(values):
+        if isinstance(value, OrderBy):
+            key.append((value.column_name, value.descendant))
+        elif isinstance(value, SQL_LOOKUP_KEY_TYPES) or maybe_table_schema(value) is not None:
+            key.append(value)
+        else:
+            # Expressions are created on every call, dont cache them
+            return None
+    return tuple(key)
+
+
+def cache_sql_lookup(key, method, *args):
+    if key is None:
+        return method(*args)
+
+    with SQL_LOOKUPS_CACHE_LOCK:
+        response = SQL_LOOKUPS_CACHE.get(key)
+        if response is not None:
+            SQL_LOOKUPS_CACHE.move_to_end(key)
+            return response
+
+    response = method(*args)
+    with SQL_LOOKUPS_CACHE_LOCK:
+        SQL_LOOKUPS_CACHE[key] = response
+        if len(SQL_LOOKUPS_CACHE) > SQL_LOOKUPS_CACHE_SIZE:
+            SQL_LOOKUPS_CACHE.popitem(last=False)
+    return response
+
+
+def iter_reshaped_rows(rows, flat_positions):
+    if not flat_positions:
+        for row in rows:
+            yield row
+    else:
+        reshape_row = None
+        for row in rows:
+            if reshape_row is None:
+                reshape_row = make_row_reshaper(row._real_fields, flat_positions)
+            yield reshape_row(row)
+
+
+def make_row_reshaper(fields, flat_positions):
+    key = (tuple(fields), tuple(flat_positions))
+    reshape_row = SQL_ROW_RESHAPERS.get(key)
+    if reshape_row is not None:
+        return reshape_row
+
+    # Flat table columns are grouped in a child tuple, like: (id, name, (id, name))
+    namespace = {}
+    fields = list(fields)
+    expressions = ['row[%s]' % i for i in range(len(fields))]
+    for name, start, end in reversed(flat_positions):
+        child_name = 'child_%s' % len(namespace)
+        namespace[child_name] = lightweight_named_tuple('result', fields[start:end])
+        child_expression = '%s((%s, ))' % (child_name, ', '.join(expressions[start:end]))
+        if 'id' in fields[start:end]:
+            id_expression = expressions[start + fields[start:end].index('id')]
+            child_expression = '(%s if %s is not None else None)' % (child_expression, id_expression)
+
+        fields[start:end] = [name]
+        expressions[start:end] = [child_expression]
+
+    namespace['named_tuple'] = lightweight_named_tuple('result', fields)
+    source = 'def reshape_row(row):\n    return named_tuple((%s, ))\n' % ', '.join(expressions)
+    exec(compile(source, '<row reshaper>', 'exec'), namespace)
+
+    reshape_row = namespace['reshape_row']
+    if len(SQL_ROW_RESHAPERS) >= SQL_LOOKUPS_CACHE_SIZE:
+        SQL_ROW_RESHAPERS.clear()
+    SQL_ROW_RESHAPERS[key] = reshape_row
+    return reshape_row
+
+
 def fill_response_with_indexs(replace_indexes, references, response):
     named_tuple = lightweight_named_tuple('result', list(response[0]._real_fields))
 
@@ -1305,6 +1481,11 @@ def initialize_sql(
         session_extension=None,
         debug=False,
         json_strict_decoder=True,
+        pool_size=None,
+        pool_max_overflow=None,
+        pool_recycle=None,
+        pool_pre_ping=False,
+        pool_timeout=None,
     ):
 
     sql_path = '%s?charset=%s' % (sql_path, encoding)
@@ -1342,15 +1523,29 @@ def initialize_sql(
         engine_kwargs['json_deserializer'] = lambda value: loads(value, strict=False)
         engine_pattern += '-json-decoder'
 
+    if pool_size:
+        engine_kwargs.update(
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=10 if pool_max_overflow is None else pool_max_overflow,
+            pool_recycle=-1 if pool_recycle is None else pool_recycle,
+            pool_pre_ping=pool_pre_ping,
+            pool_timeout=30 if pool_timeout is None else pool_timeout)
+        engine_pattern += '-pool-%s-%s-%s-%s-%s' % (
+            pool_size, pool_max_overflow, pool_recycle, pool_pre_ping, pool_timeout)
+    else:
+        engine_kwargs['poolclass'] = NullPool
+
     if engine_pattern in SQL_ENGINES:
         engine = SQL_ENGINES[engine_pattern]
     else:
         SQL_ENGINES[engine_pattern] = engine = create_engine(
             sql_path,
             echo=debug,
-            poolclass=NullPool,
             encoding=encoding,
             **engine_kwargs)
+        if pool_size:
+            listen_sql_pool(engine)
     SQL_DBS[application_name]['engine'] = engine
 
     if session_extension:
@@ -1368,6 +1563,7 @@ def initialize_sql(
     if metadata is not None:
         metadata.bind = engine
         metadata.create_all(engine)
+        add_missing_columns(engine, metadata)
 
         # Force indexes creation
         for table in metadata.sorted_tables:
@@ -1389,6 +1585,86 @@ def initialize_sql(
     return session
 
 
+def add_missing_columns(engine, metadata):
+    # create_all only creates new tables, new nullable columns are added to existing ones
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing_columns and column.nullable and column.server_default is None:
+                try:
+                    engine.execute(DDL('ALTER TABLE %s ADD COLUMN %s %s' % (
+                        engine.dialect.identifier_preparer.format_table(table),
+                        engine.dialect.identifier_preparer.format_column(column),
+                        column.type.compile(dialect=engine.dialect))))
+                except (ProgrammingError, OperationalError):
+                    pass
+
+
+def listen_sql_pool(engine):
+    metrics = SQL_POOLS_METRICS[engine] = defaultdict(int)
+
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = getpid()
+        metrics['connects'] += 1
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != getpid():
+            # Connection from parent process, never share sockets
+            connection_record.connection = connection_proxy.connection = None
+            metrics['forked_invalidated'] += 1
+            raise DisconnectionError('Connection from process %s' % connection_record.info['pid'])
+
+        connection_record.info['checkout_time'] = time()
+        metrics['checkouts'] += 1
+
+    def on_checkin(dbapi_connection, connection_record):
+        checkout_time = connection_record.info.pop('checkout_time', None)
+        if checkout_time is not None:
+            metrics['checkins'] += 1
+            used_seconds = time() - checkout_time
+            metrics['used_seconds'] += used_seconds
+            if used_seconds > metrics['max_used_seconds']:
+                metrics['max_used_seconds'] = used_seconds
+
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics['invalidated'] += 1
+
+    sqlalchemy_listen(engine, 'connect', on_connect)
+    sqlalchemy_listen(engine, 'checkout', on_checkout)
+    sqlalchemy_listen(engine, 'checkin', on_checkin)
+    sqlalchemy_listen(engine, 'invalidate', on_invalidate)
+
+    # uWSGI forks after the application load
+    register_after_fork(recreate_sql_pools)
+
+
+def recreate_sql_pools():
+    # Dont close parent connections, just forget them
+    for engine, metrics in SQL_POOLS_METRICS.items():
+        engine.pool = engine.pool.recreate()
+        metrics.clear()
+
+
+def get_sql_pool_status(application_name):
+    engine = SQL_DBS[application_name].get('engine')
+    if engine is None or engine not in SQL_POOLS_METRICS:
+        return None
+
+    status = dict(SQL_POOLS_METRICS[engine])
+    status.update(
+        pid=getpid(),
+        size=engine.pool.size(),
+        checked_in=engine.pool.checkedin(),
+        checked_out=engine.pool.checkedout(),
+        overflow=engine.pool.overflow())
+    return status
+
+
 def append_arguments(obj, key, value):
     arguments = getattr(obj, '__table_args__', None)
     if arguments is None:
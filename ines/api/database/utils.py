@@ -1,27 +1,38 @@
 # -*- coding: utf-8 -*-
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import defaultdict
+import datetime
+from decimal import Decimal
+from enum import Enum
 from functools import wraps
+from json import dumps, loads
 from time import time
+from uuid import UUID
 
 from pyramid.decorator import reify
 from sqlalchemy import and_, Column, func, not_, or_
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
-from sqlalchemy.sql.elements import Label
+from sqlalchemy.sql.elements import Label, UnaryExpression
 from sqlalchemy.sql.expression import false, true
 from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.operators import asc_op, desc_op
 from sqlalchemy.sql.schema import Table
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.util._collections import lightweight_named_tuple
 
 from ines import MARKER
 from ines.api.database import SQL_DBS
-from ines.convert import maybe_list
+from ines.convert import make_sha256, maybe_list, to_bytes, to_string
+from ines.exceptions import Error
+from ines.i18n import _
 from ines.utils import get_from_breadcrumbs, PaginationClass
 
 
 ORM_TABLES_CACHE = {}
 TABLES_BACKREFS_CACHE = defaultdict(set)
+SQL_COUNTS_CACHE = {}
 
 
 def set_timer(log_in_seconds=None):
@@ -419,7 +430,20 @@ class SQLPagination(PaginationClass):
             count_column=None,
             clear_group_by=False,
             ignore_count=False,
-            extend_entitites=False):
+            extend_entitites=False,
+            cursor=None,
+            keyset=False,
+            count_mode='exact',
+            count_cache_seconds=60,
+            stream=False):
+
+        self.cursor = cursor
+        self.keyset = False
+        self.next_cursor = None
+        self.number_of_results_is_estimate = False
+        self.stream_query = None
+        self.stream_yield_per = stream is True and 1000 or stream
+        self.reshape_rows = None
 
         if query is None:
             super(SQLPagination, self).__init__(page=1, limit_per_page=limit_per_page)
@@ -427,33 +451,295 @@ class SQLPagination(PaginationClass):
             super(SQLPagination, self).__init__(page=page, limit_per_page=limit_per_page)
 
             if self.limit_per_page != 'all':
-                if not ignore_count:
-                    entities = set()
-                    if not count_column or extend_entitites:
-                        # See https://bitbucket.org/zzzeek/sqlalchemy/issue/3320
-                        entities.update(d['expr'] for d in query.column_descriptions if d.get('expr') is not None)
-
-                    count_query = query
-                    if clear_group_by:
-                        count_query._group_by = []
-
-                    self.set_number_of_results(
-                        sum(r[0] for r in (
-                            count_query
-                                .with_entities(func.count(count_column or 1), *entities)
-                                .order_by(None)
-                                .all())))
+                if not ignore_count and count_mode != 'none':
+                    self.set_number_of_results(self.count_results(
+                        query,
+                        count_column=count_column,
+                        clear_group_by=clear_group_by,
+                        extend_entitites=extend_entitites,
+                        count_mode=count_mode,
+                        count_cache_seconds=count_cache_seconds))
+
+                if keyset or cursor:
+                    # Seek from the last row, instead of OFFSET
+                    self.keyset = True
+                    self.extend_with_keyset(query, count_column)
+                    return None
 
                 end_slice = self.page * self.limit_per_page
                 start_slice = end_slice - self.limit_per_page
                 query = query.slice(start_slice, end_slice)
 
+            elif stream:
+                # Rows are read from a server side cursor, while iterating
+                self.stream_query = query
+                if not ignore_count and count_mode != 'none':
+                    self.set_number_of_results(self.count_results(
+                        query,
+                        count_column=count_column,
+                        clear_group_by=clear_group_by,
+                        extend_entitites=extend_entitites,
+                        count_mode=count_mode,
+                        count_cache_seconds=count_cache_seconds))
+                return None
+
             self.extend(query.all())
 
             if self.limit_per_page == 'all':
                 self.set_number_of_results(len(self))
 
+    @property
+    def is_stream(self):
+        return self.stream_query is not None
+
+    @property
+    def number_of_page_results(self):
+        if self.is_stream:
+            return self.number_of_results
+        return len(self)
+
+    def __iter__(self):
+        if not self.is_stream:
+            return super(SQLPagination, self).__iter__()
 
+        rows = iter_query_stream(self.stream_query, self.stream_yield_per)
+        if self.reshape_rows is not None:
+            rows = self.reshape_rows(rows)
+        return rows
+
+    def count_results(
+            self,
+            query,
+            count_column=None,
+            clear_group_by=False,
+            extend_entitites=False,
+            count_mode='exact',
+            count_cache_seconds=60):
+
+        if count_mode == 'estimate':
+            # Planner rows of the query itself, a count returns one row
+            number_of_results = estimate_query_results(query.order_by(None))
+            if number_of_results is not None:
+                self.number_of_results_is_estimate = True
+                return number_of_results
+            # Not supported, use cached count
+            count_mode = 'cached'
+
+        entities = set()
+        if not count_column or extend_entitites:
+            # See https://bitbucket.org/zzzeek/sqlalchemy/issue/3320
+            entities.update(d['expr'] for d in query.column_descriptions if d.get('expr') is not None)
+
+        count_query = query
+        if clear_group_by:
+            count_query._group_by = []
+        count_query = count_query.with_entities(func.count(count_column or 1), *entities).order_by(None)
+
+        if count_mode == 'cached':
+            key = get_query_cache_key(count_query)
+            cached = SQL_COUNTS_CACHE.get(key)
+            if cached is not None and cached[0] > time():
+                self.number_of_results_is_estimate = True
+                return cached[1]
+
+            number_of_results = sum(r[0] for r in count_query.all())
+            if len(SQL_COUNTS_CACHE) >= 1000:
+                SQL_COUNTS_CACHE.clear()
+            SQL_COUNTS_CACHE[key] = (time() + count_cache_seconds, number_of_results)
+            return number_of_results
+
+        return sum(r[0] for r in count_query.all())
+
+    def extend_with_keyset(self, query, count_column=None):
+        order_by = get_query_order_by(query)
+        if count_column is not None and not any(column is count_column for column, descendant in order_by):
+            # Unique column, for rows with the same order values
+            order_by.append((count_column, False))
+        if not order_by:
+            raise ValueError('Keyset pagination needs order by')
+
+        is_single_entity = query_is_single_entity(query)
+        order_key = make_keyset_order_key(order_by)
+        if self.cursor:
+            query = query.filter(build_keyset_filter(
+                order_by,
+                decode_keyset_cursor(self.cursor, order_key),
+                nulls_are_high=dialect_nulls_are_high(query.session.get_bind().dialect)))
+
+        query = (
+            query
+            .order_by(None)
+            .order_by(*(column.desc() if descendant else column for column, descendant in order_by))
+            .add_columns(*(column.label('keyset_%s' % i) for i, (column, descendant) in enumerate(order_by)))
+            .limit(self.limit_per_page + 1))
+
+        response = query.all()
+        if response:
+            keys_length = len(order_by)
+            if len(response) > self.limit_per_page:
+                response = response[:self.limit_per_page]
+                self.next_cursor = encode_keyset_cursor(order_key, response[-1][-keys_length:])
+
+            if is_single_entity:
+                # Added columns make a tuple of the entity
+                self.extend(r[0] for r in response)
+            else:
+                named_tuple = lightweight_named_tuple('result', response[0]._real_fields[:-keys_length])
+                self.extend(named_tuple(r[:-keys_length]) for r in response)
+
+
+def iter_query_stream(query, yield_per=1000):
+    # Own session, the request transaction may end before all rows are sent
+    session = Session(bind=query.session.get_bind())
+    try:
+        for row in query.with_session(session).yield_per(yield_per):
+            yield row
+    finally:
+        session.close()
+
+
+def get_query_order_by(query):
+    order_by = []
+    for column in query._order_by or ():
+        descendant = False
+        if isinstance(column, UnaryExpression) and column.modifier in (desc_op, asc_op):
+            descendant = column.modifier is desc_op
+            column = column.element
+        if isinstance(column, Label):
+            column = column.element
+        order_by.append((column, descendant))
+    return order_by
+
+
+def query_is_single_entity(query):
+    descriptions = query.column_descriptions
+    return (
+        len(descriptions) == 1
+        and descriptions[0].get('entity') is not None
+        and descriptions[0]['expr'] is descriptions[0]['entity'])
+
+
+def dialect_nulls_are_high(dialect):
+    # Default NULL position, NULLs sort as the highest value on these
+    return dialect.name in ('postgresql', 'oracle')
+
+
+def build_keyset_filter(order_by, values, nulls_are_high=False):
+    if len(values) != len(order_by):
+        raise Error('cursor', _('Invalid cursor'))
+
+    # (a > 1) OR (a = 1 AND b > 2) ...
+    or_filters = []
+    for i, (column, descendant) in enumerate(order_by):
+        and_filters = [
+            order_by[j][0].is_(None) if values[j] is None else order_by[j][0] == values[j]
+            for j in range(i)]
+
+        # "column > NULL" never matches, NULLs are compared by their position
+        nulls_after = nulls_are_high != descendant
+        value = values[i]
+        if value is None:
+            if nulls_after:
+                # Nothing after NULLs on this column
+                continue
+            and_filters.append(column.isnot(None))
+        else:
+            after_filter = column < value if descendant else column > value
+            if nulls_after:
+                after_filter = or_(after_filter, column.is_(None))
+            and_filters.append(after_filter)
+
+        or_filters.append(and_(*and_filters))
+
+    if not or_filters:
+        return false()
+    return or_(*or_filters)
+
+
+def make_keyset_order_key(order_by):
+    key = ','.join('%s %s' % (column, descendant and 'desc' or 'asc') for column, descendant in order_by)
+    return make_sha256(key)[:10]
+
+
+def encode_keyset_cursor(order_key, values):
+    cursor = dumps([order_key, list(values)], default=encode_keyset_value, separators=(',', ':'))
+    return to_string(urlsafe_b64encode(to_bytes(cursor))).rstrip('=')
+
+
+def decode_keyset_cursor(cursor, order_key):
+    try:
+        cursor = to_string(urlsafe_b64decode(to_bytes(cursor + '=' * (-len(cursor) % 4))))
+        cursor_order_key, values = loads(cursor, object_hook=decode_keyset_value)
+    except (ArithmeticError, TypeError, ValueError):
+        raise Error('cursor', _('Invalid cursor'))
+
+    if cursor_order_key != order_key:
+        # Cursor from other order by
+        raise Error('cursor', _('Invalid cursor'))
+    return values
+
+
+def encode_keyset_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    elif isinstance(value, datetime.time):
+        return {'time': value.isoformat()}
+    elif isinstance(value, datetime.timedelta):
+        return {'timedelta': value.total_seconds()}
+    elif isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    elif isinstance(value, UUID):
+        return {'uuid': str(value)}
+    elif isinstance(value, Enum):
+        # Enum columns accept member names
+        return value.name
+    elif isinstance(value, bytes):
+        return {'bytes': to_string(urlsafe_b64encode(value))}
+    raise Error('order_by', _('Invalid order by for cursor pagination'))
+
+
+def decode_keyset_value(value):
+    if 'datetime' in value:
+        return datetime.datetime.fromisoformat(value['datetime'])
+    elif 'date' in value:
+        return datetime.date.fromisoformat(value['date'])
+    elif 'time' in value:
+        return datetime.time.fromisoformat(value['time'])
+    elif 'timedelta' in value:
+        return datetime.timedelta(seconds=value['timedelta'])
+    elif 'decimal' in value:
+        return Decimal(value['decimal'])
+    elif 'uuid' in value:
+        return UUID(value['uuid'])
+    elif 'bytes' in value:
+        return urlsafe_b64decode(to_bytes(value['bytes']))
+    return value
+
+
+def get_query_cache_key(query):
+    statement = query.statement.compile(dialect=query.session.get_bind().dialect)
+    return make_sha256('%s %r' % (statement, sorted(statement.params.items())))
+
+
+def estimate_query_results(query):
+    bind = query.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return None
+
+    # Planner rows, no table scan
+    # Sent on the DBAPI cursor, the statement is already compiled with the driver paramstyle
+    statement = query.statement.compile(dialect=bind.dialect)
+    cursor = query.session.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % statement, statement.params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, str):
+        plan = loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
 
 
 # TODO
@@ -1,33 +1,58 @@
 # -*- coding: utf-8 -*-
 
 from base64 import b64encode
-from collections import defaultdict
+from bisect import bisect_right
+from collections import defaultdict, deque, OrderedDict
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
 from io import BytesIO
 from math import ceil
-from os.path import basename, isfile, join as join_paths
+from multiprocessing import get_context
+from os import cpu_count, getpid, mkdir, sep, walk
+from os.path import basename, getmtime, getsize, isfile, join as join_paths, relpath
+from random import random
 from tempfile import gettempdir
+from threading import Lock
+from time import sleep
 
 from pyramid.decorator import reify
 from pyramid.settings import asbool
-from sqlalchemy import Column, DateTime, ForeignKey, func, Index, Integer, String, Unicode, UnicodeText
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, func, Index, Integer, String, Unicode, UnicodeText
 from sqlalchemy.orm import aliased
 
-from ines import lazy_import_module, OPEN_BLOCK_SIZE, TODAY_DATE
+from ines import lazy_import_module, NOW, NOW_TIME, OPEN_BLOCK_SIZE, TODAY_DATE
 from ines.api.database.sql import (
     BaseSQLSession, BaseSQLSessionManager, new_lightweight_named_tuple, sql_declarative_base)
 from ines.api.jobs import job
+from ines.cache import CACHE_COMPRESSIONS
 from ines.convert import maybe_date, maybe_integer, maybe_set, maybe_string, to_bytes, to_string
 from ines.exceptions import Error
 from ines.i18n import _
 from ines.mimetype import find_mimetype
+from ines.request import make_request
+from ines.system import start_system_thread, thread_is_running
 from ines.url import get_url_file, open_json_url
 from ines.utils import (
-    file_unique_code, get_dir_filenames, get_open_file, make_unique_hash, make_dir, put_binary_on_file,
-    remove_file_quietly, string_unique_code)
+    get_dir_filenames, get_open_file, iter_binary_blocks, iter_content_defined_blocks, iter_file_chunks,
+    make_unique_hash, make_dir, put_binary_on_file, remove_file_quietly)
 
 
 FilesDeclarative = sql_declarative_base('ines.storage')
 FILES_TEMPORARY_DIR = join_paths(gettempdir(), 'ines-tmp-files')
+STORAGE_SCRUB_CURSOR_KEY = 'ines storage scrub cursor'
+STORAGE_SCRUB_REPORT_KEY = 'ines storage scrub report'
+# Blocks looked up on database together, while reading the input
+SPOOL_LOOKUP_BLOCKS = 64
+
+# Already compressed, don't compress blocks
+COMPRESSED_MIMETYPES = (
+    'image/', 'video/', 'audio/', 'font/woff',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/x-7z-compressed', 'application/x-rar-compressed', 'application/vnd.rar', 'application/pdf',
+    'application/vnd.openxmlformats-officedocument.', 'application/vnd.oasis.opendocument.',
+    'application/epub+zip', 'application/java-archive')
+COMPRESSIBLE_MIMETYPES = ('image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'image/tiff', 'audio/wav', 'audio/x-wav')
 
 
 class BaseStorageSessionManager(BaseSQLSessionManager):
@@ -38,6 +63,10 @@ class BaseStorageSessionManager(BaseSQLSessionManager):
         super(BaseStorageSessionManager, self).__init__(*args, **kwargs)
         make_dir(self.settings['folder_path'])
 
+        self.blocks_folders = BlocksFoldersAllocator(
+            self.settings['folder_path'],
+            int(self.settings.get('max_blocks_per_folder') or 250))
+
         if issubclass(self.session, BaseStorageWithImageSession):
             self.image_cls = lazy_import_module('PIL.Image')
             self.resize_quality = self.image_cls.ANTIALIAS
@@ -54,60 +83,74 @@ class BaseStorageSessionManager(BaseSQLSessionManager):
             self.tinypng_api = self.settings.get('tinypng_api')
             self.tinypng_locked_months = []
 
+            # Thumbnails created on background, as (key, id, application_code, resize_name)
+            self.thumbnails_queue = OrderedDict()
+            self.thumbnails_queue_lock = Lock()
+
 
 class BaseStorageSession(BaseSQLSession):
     __api_name__ = 'storage'
 
     def save_file_path(self, binary, filename=None, compressed=False):
-        # Generate a unique code using SHA256
-        if isinstance(binary, StorageFile):
-            filename = filename or binary.name
-            binary = binary.read()
-        if isinstance(binary, (bytes, str)):
-            unique_code = string_unique_code(binary)
-        else:
-            unique_code = file_unique_code(binary)
-            if not filename:
+        if not filename:
+            if isinstance(binary, StorageFile):
+                filename = binary.name
+            elif not isinstance(binary, (bytes, str)) and isinstance(getattr(binary, 'name', None), str):
                 filename = basename(binary.name)
 
+        # Read input only once: hash file and blocks, and write new blocks
+        unique_code, mimetype, blocks, spooled_paths, existing_blocks = self.spool_blocks(binary, filename)
+
         lock_key = 'storage save %s' % unique_code
-        self.cache.lock(lock_key)
         try:
-            file_path = (
-                self.session
-                .query(*FilePath.__table__.c.values())
-                .filter(FilePath.code == unique_code)
-                .first())
+            # Existing files only need to wait for a writer, readers go in parallel
+            with self.cache.locked(lock_key, shared=True):
+                file_path = (
+                    self.session
+                    .query(*FilePath.__table__.c.values())
+                    .filter(FilePath.code == unique_code)
+                    .first())
+            if file_path:
+                return file_path
+
+            self.cache.lock(lock_key)
+            try:
+                file_path = (
+                    self.session
+                    .query(*FilePath.__table__.c.values())
+                    .filter(FilePath.code == unique_code)
+                    .first())
 
-            # Save file if dont exists
-            if not file_path:
-                # Create a new filepath
-                filename = maybe_string(filename)
-                mimetype = find_mimetype(filename=filename, header_or_file=binary)
-                file_path = FilePath(code=unique_code, mimetype=maybe_string(mimetype), compressed=compressed)
+                # Save file if dont exists
+                if not file_path:
+                    # Create a new filepath
+                    file_path = FilePath(code=unique_code, mimetype=mimetype, compressed=compressed or None)
 
-                to_add = []
-                file_size = 0
+                    to_add = []
+                    file_size = 0
 
-                # Save blocks
-                blocks = self.save_blocks(binary)
+                    # Save blocks
+                    blocks = self.save_spooled_blocks(blocks, spooled_paths, existing_blocks)
 
-                for order, (block_id, block_size) in enumerate(blocks):
-                    to_add.append(FileBlock(file_id_block=block_id, order=order))
-                    file_size += block_size
+                    for order, (block_id, block_size) in enumerate(blocks):
+                        to_add.append(FileBlock(file_id_block=block_id, order=order))
+                        file_size += block_size
 
-                # Add file path to DB
-                file_path.size = file_size
-                file_path.id = self.direct_insert(file_path).inserted_primary_key[0]
+                    # Add file path to DB
+                    file_path.size = file_size
+                    file_path.id = self.direct_insert(file_path).inserted_primary_key[0]
 
-                # Relate blocks and file path
-                for block_relation in to_add:
-                    block_relation.file_id_path = file_path.id
-                    self.direct_insert(block_relation)
+                    # Relate blocks and file path
+                    for block_relation in to_add:
+                        block_relation.file_id_path = file_path.id
+                    self.direct_insert_many(to_add)
 
-            return file_path
+                return file_path
+            finally:
+                self.cache.unlock(lock_key)
         finally:
-            self.cache.unlock(lock_key)
+            # Remove blocks not used
+            self.remove_spooled_paths(spooled_paths)
 
     def save_file(
             self,
@@ -152,28 +195,33 @@ class BaseStorageSession(BaseSQLSession):
     def block_size(self):
         return int(self.settings.get('file_block_size') or OPEN_BLOCK_SIZE)
 
+    @reify
+    def content_defined_blocks(self):
+        if self.settings.get('block_chunking') == 'content':
+            avg_size = int(self.settings.get('avg_block_size') or self.block_size)
+            return (
+                int(self.settings.get('min_block_size') or avg_size // 4),
+                avg_size,
+                int(self.settings.get('max_block_size') or avg_size * 4))
+
+    def iter_blocks(self, binary):
+        if self.content_defined_blocks:
+            return iter_content_defined_blocks(binary, *self.content_defined_blocks)
+        else:
+            return iter_binary_blocks(binary, self.block_size)
+
     @reify
     def storage_path(self):
         return self.settings['folder_path']
 
     @reify
     def max_blocks_per_folder(self):
-        return int(self.settings.get('max_blocks_per_folder') or 250)
+        return self.api_session_manager.blocks_folders.max_blocks_per_folder
 
     def create_file_path(self, file_date=None):
         file_date = maybe_date(file_date or TODAY_DATE())
         base_folder_path = file_date.strftime('%Y%m/%d')
-
-        last_folder = 0
-        full_base_folder_path = join_paths(self.storage_path, base_folder_path)
-        folders = sorted(int(i) for i in get_dir_filenames(full_base_folder_path) if i.isdigit())
-        if folders:
-            last_folder = folders[-1]
-        folder_path = join_paths(base_folder_path, last_folder)
-
-        full_folder_path = join_paths(self.storage_path, folder_path)
-        if len(get_dir_filenames(full_folder_path)) >= self.max_blocks_per_folder:
-            folder_path = join_paths(base_folder_path, last_folder + 1)
+        folder_path = self.api_session_manager.blocks_folders.allocate(base_folder_path)
 
         while True:
             filename = make_unique_hash(length=80)
@@ -182,76 +230,144 @@ class BaseStorageSession(BaseSQLSession):
             if not isfile(full_path):
                 return full_path, path
 
-    def save_blocks(self, binary):
-        if isinstance(binary, (bytes, str)):
-            binary_is_string = True
+    @reify
+    def block_compression(self):
+        compression = self.settings.get('block_compression')
+        if compression:
+            if compression not in CACHE_COMPRESSIONS:
+                raise ValueError('Invalid block compression "%s"' % compression)
+
+            code, compress, decompress, module_name = CACHE_COMPRESSIONS[compression]
+            if module_name:
+                lazy_import_module(module_name)
+            return compression, compress
+
+    @reify
+    def block_compression_level(self):
+        return maybe_integer(self.settings.get('block_compression_level'))
+
+    @reify
+    def block_compression_min_ratio(self):
+        return float(self.settings.get('block_compression_min_ratio') or 0.9)
+
+    def compress_block(self, block):
+        compression, compress = self.block_compression
+        compressed_block = compress(block, self.block_compression_level)
+        if len(compressed_block) < len(block) * self.block_compression_min_ratio:
+            return compression, compressed_block
         else:
-            binary.seek(0)
-            binary_is_string = False
+            return None, block
 
+    def spool_blocks(self, binary, filename=None):
+        file_hash = sha256()
+        mimetype = None
+        compress_blocks = False
         blocks = []
-        block_size = self.block_size
-        while_binary = binary
-        while True:
-            if binary_is_string:
-                block = while_binary[:block_size]
-                while_binary = while_binary[block_size:]
-            else:
-                block = while_binary.read(block_size)
-            if not block:
-                break
+        spooled_paths = {}
+        existing_blocks = {}
+        to_spool = OrderedDict()
+
+        try:
+            for i, block in enumerate(self.iter_blocks(binary)):
+                if not i:
+                    mimetype = maybe_string(find_mimetype(filename=maybe_string(filename), header_or_file=block))
+                    compress_blocks = bool(self.block_compression and is_compressible_mimetype(mimetype))
+
+                file_hash.update(block)
+                block_hash = sha256(block).hexdigest()
+                blocks.append((block_hash, len(block)))
+
+                if (block_hash not in spooled_paths
+                        and block_hash not in existing_blocks
+                        and block_hash not in to_spool):
+                    to_spool[block_hash] = block
+                    if len(to_spool) >= SPOOL_LOOKUP_BLOCKS:
+                        self.spool_missing_blocks(to_spool, compress_blocks, spooled_paths, existing_blocks)
+
+            if to_spool:
+                self.spool_missing_blocks(to_spool, compress_blocks, spooled_paths, existing_blocks)
+        except:
+            self.remove_spooled_paths(spooled_paths)
+            raise
 
-            # Create hash of the block
-            blocks.append(string_unique_code(block))
         if not blocks:
             raise ValueError('Empty file')
 
-        # Lock all blocks
-        locked_keys = {k: 'storage block save %s' % k for k in set(blocks)}
-        for lock_key in locked_keys.values():
-            self.cache.lock(lock_key)
+        return file_hash.hexdigest(), mimetype, blocks, spooled_paths, existing_blocks
 
-        response = []
-        try:
-            # Look for existing blocks
-            existing_blocks = {}
+    def spool_missing_blocks(self, to_spool, compress_blocks, spooled_paths, existing_blocks):
+        # Only blocks we don't have are written
+        existing_blocks.update(self.get_existing_blocks(to_spool.keys()))
+
+        for block_hash, block in to_spool.items():
+            if block_hash not in existing_blocks:
+                compression = None
+                if compress_blocks:
+                    compression, block = self.compress_block(block)
+
+                full_path, path = self.create_file_path()
+                put_binary_on_file(full_path, block, make_dir_recursively=True)
+                spooled_paths[block_hash] = (path, compression)
+
+        to_spool.clear()
+
+    def get_existing_blocks(self, codes):
+        codes = list(codes)
+        existing_blocks = {}
+        for i in range(0, len(codes), 500):
             for block in (
                     self.session
                     .query(BlockPath.id, BlockPath.size, BlockPath.code)
-                    .filter(BlockPath.code.in_(set(blocks)))
+                    .filter(BlockPath.code.in_(codes[i:i + 500]))
                     .all()):
                 existing_blocks[block.code] = (block.id, block.size)
-                self.cache.unlock(locked_keys.pop(block.code))
+        return existing_blocks
 
-            # Add missing blocks
-            for order, block_hash in enumerate(blocks):
-                if block_hash in existing_blocks:
-                    response.append(existing_blocks[block_hash])
-                else:
-                    if binary_is_string:
-                        start_idx = order * block_size
-                        block_binary = binary[start_idx:start_idx + block_size]
-                    else:
-                        binary.seek(order * block_size)
-                        block_binary = binary.read(block_size)
+    def remove_spooled_paths(self, spooled_paths):
+        for path, compression in spooled_paths.values():
+            remove_file_quietly(join_paths(self.storage_path, path))
+        spooled_paths.clear()
+
+    def save_spooled_blocks(self, blocks, spooled_paths, existing_blocks=None):
+        blocks_sizes = dict(blocks)
+
+        # Lock all blocks
+        locked_keys = ['storage block save %s' % k for k in blocks_sizes.keys()]
+        self.cache.lock_many(locked_keys)
+
+        try:
+            # Look for existing blocks, again
+            found_blocks = self.get_existing_blocks(blocks_sizes.keys())
+            if existing_blocks and set(existing_blocks).difference(found_blocks):
+                # Block was not spooled, because it existed
+                raise Error('file', 'File blocks removed while saving, try again')
+            existing_blocks = found_blocks
 
-                    full_path, path = self.create_file_path()
-                    put_binary_on_file(full_path, block_binary, make_dir_recursively=True)
+            # Add missing blocks
+            new_blocks = [
+                BlockPath(path=path, size=blocks_sizes[block_hash], code=block_hash, compression=compression)
+                for block_hash, (path, compression) in spooled_paths.items()
+                if block_hash not in existing_blocks]
 
-                    # Lets flush the session to prevent waiting in a possible locked block
-                    block_size = len(block_binary)
-                    block_response = self.direct_insert(BlockPath(path=path, size=block_size, code=block_hash))
-                    block_id = block_response.inserted_primary_key[0]
+            if new_blocks:
+                blocks_ids = self.direct_insert_many(new_blocks, unique_column=BlockPath.code)
+                for block, block_id in zip(new_blocks, blocks_ids):
+                    existing_blocks[block.code] = (block_id, block.size)
 
-                    response.append((block_id, block_size))
-                    existing_blocks[block_hash] = (block_id, block_size)
-                    self.cache.unlock(locked_keys.pop(block_hash))
+                    # Block path is in use, keep it
+                    spooled_paths.pop(block.code)
 
         finally:
-            for lock_key in locked_keys.values():
-                self.cache.unlock(lock_key)
+            self.cache.unlock_many(locked_keys)
 
-        return response
+        return [existing_blocks[block_hash] for block_hash, block_size in blocks]
+
+    def save_blocks(self, binary):
+        unique_code, mimetype, blocks, spooled_paths, existing_blocks = self.spool_blocks(binary)
+        try:
+            return self.save_spooled_blocks(blocks, spooled_paths, existing_blocks)
+        finally:
+            self.remove_spooled_paths(spooled_paths)
 
     def delete_file_paths(self, *ids):
         if not ids:
@@ -335,6 +451,162 @@ class BaseStorageSession(BaseSQLSession):
 
         return True
 
+    @job(second=0, minute=45,
+         title=_('Verify storage'),
+         unique_name='ines:scrub_storage')
+    def scrub_storage(self):
+        chunk_size = maybe_integer(self.settings.get('scrub.chunk_size')) or 500
+        chunk_sleep = float(self.settings.get('scrub.chunk_sleep') or 0.1)
+        sample_rate = float(self.settings.get('scrub.sample_rate') or 0.01)
+        max_seconds = maybe_integer(self.settings.get('scrub.max_seconds')) or 600
+        grace_seconds = maybe_integer(self.settings.get('scrub.grace_seconds')) or 86400
+
+        # Continue where the last run stopped
+        cursor = self.cache.get(STORAGE_SCRUB_CURSOR_KEY, expire=None) or {'block_id': 0, 'folder': None}
+        report = self.cache.get(STORAGE_SCRUB_REPORT_KEY, expire=None)
+        if not report or report['finished']:
+            report = {
+                'started_date': NOW(),
+                'finished': False,
+                'blocks': 0,
+                'verified_blocks': 0,
+                'removed_blocks': 0,
+                'missing_blocks': [],
+                'corrupted_blocks': [],
+                'folders': 0,
+                'removed_files': 0}
+
+        stop_time = NOW_TIME() + max_seconds
+        while cursor['block_id'] is not None and NOW_TIME() < stop_time:
+            cursor['block_id'] = self.scrub_blocks(cursor['block_id'], chunk_size, sample_rate, grace_seconds, report)
+            sleep(chunk_sleep)
+
+        if cursor['block_id'] is None:
+            for folder_path, filenames in iter_storage_folders(self.storage_path, cursor['folder']):
+                if NOW_TIME() >= stop_time:
+                    break
+
+                self.scrub_folder(folder_path, filenames, chunk_size, grace_seconds, report)
+                cursor['folder'] = folder_path
+                sleep(chunk_sleep)
+            else:
+                report['finished'] = True
+                report['finished_date'] = NOW()
+
+        if report['finished']:
+            self.cache.remove(STORAGE_SCRUB_CURSOR_KEY)
+            if report['missing_blocks'] or report['corrupted_blocks']:
+                self.logging.log_error(
+                    'storage_scrub',
+                    'Missing blocks: %s. Corrupted blocks: %s' % (
+                        ', '.join(report['missing_blocks']) or '-',
+                        ', '.join(report['corrupted_blocks']) or '-'))
+        else:
+            self.cache.put(STORAGE_SCRUB_CURSOR_KEY, cursor, expire=None)
+
+        self.cache.put(STORAGE_SCRUB_REPORT_KEY, report, expire=None)
+        return report
+
+    def get_scrub_report(self):
+        return self.cache.get(STORAGE_SCRUB_REPORT_KEY, expire=None)
+
+    def scrub_blocks(self, last_id, chunk_size, sample_rate, grace_seconds, report):
+        blocks = (
+            self.session
+            .query(BlockPath.id, BlockPath.code, BlockPath.path, BlockPath.compression)
+            .filter(BlockPath.id > last_id)
+            .order_by(BlockPath.id)
+            .limit(chunk_size)
+            .all())
+        if not blocks:
+            return None
+
+        report['blocks'] += len(blocks)
+        referenced = self.get_referenced_blocks_ids(b.id for b in blocks)
+
+        unreferenced = [b for b in blocks if b.id not in referenced]
+        if unreferenced:
+            self.delete_unreferenced_blocks(unreferenced, grace_seconds, report)
+
+        for block in blocks:
+            if block.id in referenced:
+                full_path = join_paths(self.storage_path, block.path)
+                if not isfile(full_path):
+                    add_to_scrub_report(report, 'missing_blocks', block.path)
+                elif random() < sample_rate:
+                    report['verified_blocks'] += 1
+                    if get_block_sha256(full_path, block.compression) != block.code:
+                        add_to_scrub_report(report, 'corrupted_blocks', block.path)
+
+        return blocks[-1].id
+
+    def get_referenced_blocks_ids(self, ids):
+        return set(
+            f.file_id_block
+            for f in (
+                self.session
+                .query(FileBlock.file_id_block)
+                .filter(FileBlock.file_id_block.in_(set(ids)))
+                .distinct()
+                .all()))
+
+    def delete_unreferenced_blocks(self, blocks, grace_seconds, report):
+        # New blocks are linked to files after the block lock is released
+        old_date = NOW() - timedelta(seconds=grace_seconds)
+
+        locked_keys = ['storage block save %s' % b.code for b in blocks]
+        self.cache.lock_many(locked_keys)
+        try:
+            # Blocks can be used meanwhile
+            old_blocks_ids = set(
+                b.id
+                for b in (
+                    self.session
+                    .query(BlockPath.id)
+                    .filter(BlockPath.id.in_([b.id for b in blocks]))
+                    .filter(BlockPath.created_date < old_date)
+                    .all()))
+            if old_blocks_ids:
+                old_blocks_ids.difference_update(self.get_referenced_blocks_ids(old_blocks_ids))
+            blocks = [b for b in blocks if b.id in old_blocks_ids]
+            if blocks:
+                self.direct_delete(BlockPath, BlockPath.id.in_([b.id for b in blocks]))
+                self.flush()
+        finally:
+            self.cache.unlock_many(locked_keys)
+
+        for block in blocks:
+            remove_file_quietly(join_paths(self.storage_path, block.path))
+        report['removed_blocks'] += len(blocks)
+
+    def scrub_folder(self, folder_path, filenames, chunk_size, grace_seconds, report):
+        report['folders'] += 1
+
+        # New blocks are saved on disk before the database
+        old_time = NOW_TIME() - grace_seconds
+
+        filenames = list(filenames)
+        for i in range(0, len(filenames), chunk_size):
+            paths = set(join_paths(folder_path, filename) for filename in filenames[i:i + chunk_size])
+            paths.difference_update(
+                b.path
+                for b in (
+                    self.session
+                    .query(BlockPath.path)
+                    .filter(BlockPath.path.in_(paths))
+                    .all()))
+
+            for path in paths:
+                full_path = join_paths(self.storage_path, path)
+                try:
+                    modified_time = getmtime(full_path)
+                except OSError:
+                    continue
+
+                if modified_time < old_time:
+                    remove_file_quietly(full_path)
+                    report['removed_files'] += 1
+
     def get_files(
             self,
             key=None,
@@ -440,20 +712,29 @@ class BaseStorageSession(BaseSQLSession):
         filenames = {}
         file_ids = set(file_ids)
         files_blocks = defaultdict(list)
+        files_blocks_sizes = defaultdict(list)
+        files_blocks_compressions = defaultdict(list)
 
         for block in (
                 self.session
-                .query(File.id, File.filename, BlockPath.path)
+                .query(File.id, File.filename, BlockPath.path, BlockPath.size, BlockPath.compression)
                 .filter(BlockPath.id == FileBlock.file_id_block)
                 .filter(File.file_id == FileBlock.file_id_path)
                 .filter(File.id.in_(file_ids))
                 .order_by(FileBlock.order)
                 .all()):
             files_blocks[block.id].append(block.path)
+            files_blocks_sizes[block.id].append(block.size)
+            files_blocks_compressions[block.id].append(block.compression)
             filenames[block.id] = block.filename
 
         return dict(
-            (i, StorageFile(self.storage_path, filenames.get(i), files_blocks[i]))
+            (i, StorageFile(
+                self.storage_path,
+                filenames.get(i),
+                files_blocks[i],
+                blocks_sizes=files_blocks_sizes[i],
+                blocks_compressions=files_blocks_compressions[i]))
             for i in file_ids)
 
     def get_file_binary(self, file_id):
@@ -477,25 +758,91 @@ class BaseStorageWithImageSession(BaseStorageSession):
         else:
             return self.api_session_manager.image_cls.open(binary_or_file)
 
+    def get_thumbnail_cache_key(self, key, resize_name):
+        return 'ines storage thumbnail %s %s' % (key, resize_name)
+
     def get_thumbnail(self, key, resize_name, attributes=None):
+        cache_key = self.get_thumbnail_cache_key(key, resize_name)
+        attributes = set(attributes or ['id'])
+        attributes.add('id')
+
+        pending_seconds = maybe_integer(self.settings.get('thumb.pending_seconds')) or 60
+
+        # Cached as (file id, is resized, pending since)
+        cached = self.cache.get(cache_key, expire=None)
+        if cached:
+            fid, is_resized = cached[:2]
+            if not is_resized:
+                # Older values have no time, look for the resize again
+                if len(cached) > 2 and NOW_TIME() - cached[2] < pending_seconds:
+                    return self.get_thumbnail_placeholder(fid, attributes)
+            else:
+                resized = self.get_file(id=fid, attributes=attributes)
+                if resized:
+                    return resized
+            self.cache.remove(cache_key)
+
         resized = self.get_files(
             parent_key=key,
             type_key='resize-%s' % resize_name,
             only_one=True,
             attributes=attributes)
         if resized:
+            self.cache.put(cache_key, (resized.id, True), expire=None)
             return resized
 
         f = self.session.query(File.id, File.application_code).filter(File.key == key).first()
-        if (f and resize_name in self.api_session_manager.resizes.get(f.application_code, [])
-              and self.resize_image(f.id, f.application_code, resize_name)):
-            # Thumb created on the fly
-            self.flush()
-            return self.get_files(
-                parent_key=key,
-                type_key='resize-%s' % resize_name,
-                only_one=True,
-                attributes=attributes)
+        if f and resize_name in self.api_session_manager.resizes.get(f.application_code, []):
+            # Thumb created on background, send the original meanwhile
+            self.cache.put(cache_key, (f.id, False, NOW_TIME()), expire=pending_seconds)
+            self.add_thumbnail_to_queue(key, f.id, f.application_code, resize_name)
+            return self.get_thumbnail_placeholder(f.id, attributes)
+
+    def get_thumbnail_placeholder(self, fid, attributes=None):
+        placeholder_key = self.settings.get('thumb.placeholder_key')
+        if placeholder_key:
+            return self.get_file(key=placeholder_key, attributes=attributes)
+        else:
+            return self.get_file(id=fid, attributes=attributes)
+
+    def add_thumbnail_to_queue(self, key, fid, application_code, resize_name):
+        manager = self.api_session_manager
+        with manager.thumbnails_queue_lock:
+            manager.thumbnails_queue[(key, fid, application_code, resize_name)] = True
+
+        if not thread_is_running('ines:thumbnails'):
+            # Request session can be closed before we finish
+            environ = self.request.environ.copy()
+
+            def create_thumbnails():
+                with manager.thumbnails_queue_lock:
+                    if not manager.thumbnails_queue:
+                        return 0.5
+                api_session = manager(make_request(self.config, environ))
+                api_session.create_queued_thumbnails()
+
+            try:
+                start_system_thread('ines:thumbnails', create_thumbnails)
+            except KeyError:
+                # Already started by other thread
+                pass
+
+    def create_queued_thumbnails(self):
+        manager = self.api_session_manager
+        while True:
+            with manager.thumbnails_queue_lock:
+                if not manager.thumbnails_queue:
+                    break
+                (key, fid, application_code, resize_name), _ = manager.thumbnails_queue.popitem(last=False)
+
+            try:
+                self.resize_image(fid, application_code, resize_name)
+                self.flush()
+            except Exception as error:
+                self.rollback()
+                self.logging.log_critical('thumbnail_error', str(error))
+            else:
+                self.cache.remove(self.get_thumbnail_cache_key(key, resize_name))
 
     def resize_image(self, fid, application_code, resize_name):
         if application_code not in self.api_session_manager.resizes:
@@ -509,126 +856,140 @@ class BaseStorageWithImageSession(BaseStorageSession):
         if not resize_width and not resize_height:
             raise Error('resize', 'Invalid resize options')
 
-        file_info = self.get_file(
-            id=fid,
-            application_code=application_code,
-            attributes=['open_file', 'key', 'filename', 'title', 'code_key'])
-        if not file_info:
-            raise Error('file', 'File ID not found')
-
-        temporary_path = None
-        type_key = 'resize-%s' % resize_name
-        filename = None
-        if file_info.filename:
-            filename = '%s-%s' % (resize_name, file_info.filename)
-
-        lock_key = 'create image resize %s %s' % (fid, resize_name)
-        self.cache.lock(lock_key)
-        try:
-            existing = (
+        # Created by someone else, don't decode the image again
+        with self.cache.locked('create image resize %s %s' % (fid, resize_name), shared=True):
+            exists = (
                 self.session
-                .query(File)
+                .query(File.id)
                 .filter(File.parent_id == fid)
                 .filter(File.application_code == application_code)
-                .filter(File.type_key == type_key)
+                .filter(File.type_key == 'resize-%s' % resize_name)
                 .first())
+        if exists:
+            return True
 
-            if not existing:
-                original_temporary_path, original_file = create_temporary_file(mode='wb')
-                original_file.write(file_info.open_file.read())
-                original_file.close()
-
-                original_file = get_open_file(original_temporary_path)
-                im = self.api_session_manager.image_cls.open(original_file)
-
-                width = int(im.size[0])
-                height = int(im.size[1])
+        file_info = self.get_file(
+            id=fid,
+            application_code=application_code,
+            attributes=['open_file', 'id', 'key', 'filename', 'title', 'code_key'])
+        if not file_info:
+            raise Error('file', 'File ID not found')
 
-                if not resize_width:
-                    resize_width = ceil((float(width) * resize_height) / height)
+        resized = make_image_resizes(
+            file_info.open_file.read(),
+            {resize_name: (resize_width, resize_height)},
+            self.api_session_manager.resize_quality)
+        self.save_image_resizes(file_info, application_code, resized)
+        return True
 
-                elif not resize_height:
-                    resize_height = ceil((float(resize_width) * height) / width)
+    def save_image_resizes(self, file_info, application_code, resized):
+        type_keys = dict((name, 'resize-%s' % name) for name in resized.keys())
+        lock_keys = ['create image resize %s %s' % (file_info.id, name) for name in resized.keys()]
 
-                else:
-                    resize_racio = resize_width / float(resize_height)
-                    image_racio = width / float(height)
-
-                    if image_racio < resize_racio:
-                        # Crop image on height
-                        crop_size = ceil(round(height - (width / resize_racio)) / 2)
-                        lower_position = int(height - int(crop_size))
-                        # Crop as left, upper, right, and lower pixel
-                        im = im.crop((0, int(crop_size), width, lower_position))
-
-                    elif image_racio > resize_racio:
-                        crop_size = ceil(round(width - (height * resize_racio)) / 2)
-                        right_position = int(width - int(crop_size))
-                        # Crop as left, upper, right, and lower pixel
-                        im = im.crop((int(crop_size), 0, right_position, height))
-
-                # Resize image
-                im = im.resize((int(resize_width), int(resize_height)), self.api_session_manager.resize_quality)
-                temporary_path = save_temporary_image(im)
-                resized = get_open_file(temporary_path)
-
-                original_file.close()
-                remove_file_quietly(original_temporary_path)
-
-                self.save_file(
-                    resized,
-                    application_code=application_code,
-                    code_key=file_info.code_key,
-                    type_key=type_key,
-                    filename=filename,
-                    title=file_info.title,
-                    parent_id=fid)
+        self.cache.lock_many(lock_keys)
+        try:
+            existing = set(
+                f.type_key
+                for f in (
+                    self.session
+                    .query(File.type_key)
+                    .filter(File.parent_id == file_info.id)
+                    .filter(File.application_code == application_code)
+                    .filter(File.type_key.in_(type_keys.values()))
+                    .all()))
 
+            for resize_name, binary in resized.items():
+                if type_keys[resize_name] not in existing:
+                    filename = None
+                    if file_info.filename:
+                        filename = '%s-%s' % (resize_name, file_info.filename)
+
+                    self.save_file(
+                        BytesIO(binary),
+                        application_code=application_code,
+                        code_key=file_info.code_key,
+                        type_key=type_keys[resize_name],
+                        filename=filename,
+                        title=file_info.title,
+                        parent_id=file_info.id)
         finally:
-            self.cache.unlock(lock_key)
-
-            if temporary_path:
-                remove_file_quietly(temporary_path)
-
-        return True
+            self.cache.unlock_many(lock_keys)
 
     @job(second=0, minute=[0, 30],
          title=_('Create images'),
          unique_name='ines:create_image_resizes')
     def create_image_resizes(self):
-        if not asbool(self.settings.get('thumb.create_on_add')) or not self.api_session_manager.resizes:
+        resizes = self.api_session_manager.resizes
+        if not asbool(self.settings.get('thumb.create_on_add')) or not resizes:
             return None
 
-        existing = defaultdict(lambda: defaultdict(list))
+        existing = defaultdict(set)
         for t in (
                 self.session
-                .query(File.parent_id, File.type_key, File.application_code)
-                .filter(File.application_code.in_(self.api_session_manager.resizes.keys()))
+                .query(File.parent_id, File.type_key)
+                .filter(File.application_code.in_(resizes.keys()))
                 .filter(File.parent_id.isnot(None))
-                .filter(File.type_key.like('thumb-%'))
+                .filter(File.type_key.like('resize-%'))
                 .all()):
-            existing[t.application_code][t.parent_id].append(t.type_key.replace('thumb-', '', 1))
+            existing[t.parent_id].add(t.type_key.replace('resize-', '', 1))
 
-        files = defaultdict(list)
+        to_resize = []
         for f in (
                 self.session
-                .query(File.id, File.application_code)
+                .query(File.id, File.application_code, File.filename, File.title, File.code_key)
                 .filter(File.parent_id.is_(None))
-                .filter(File.application_code.in_(self.api_session_manager.resizes.keys()))
+                .filter(File.application_code.in_(resizes.keys()))
                 .all()):
-            files[f.application_code].append(f.id)
+            missing = {}
+            for resize_name, resize in resizes[f.application_code].items():
+                if resize_name not in existing[f.id]:
+                    missing[resize_name] = (maybe_integer(resize.get('width')), maybe_integer(resize.get('height')))
+            if missing:
+                to_resize.append((f, missing))
+
+        if not to_resize:
+            return None
+
+        workers = maybe_integer(self.settings.get('thumb.workers'))
+        if workers is None:
+            workers = cpu_count() or 1
+        batch_size = maybe_integer(self.settings.get('thumb.batch_size')) or 20
+
+        # Decode and encode on other processes, database is used only here
+        # Spawned, so workers don't inherit locks, sockets and threads from this process
+        executor = workers > 1 and ProcessPoolExecutor(workers, mp_context=get_context('spawn')) or None
+        try:
+            for i, (file_info, resized) in enumerate(self.iter_image_resizes(to_resize, executor, workers * 2)):
+                if resized:
+                    self.save_image_resizes(file_info, file_info.application_code, resized)
+                if not (i + 1) % batch_size:
+                    self.flush()
+            self.flush()
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-        for application_code, resize_names in self.api_session_manager.resizes.items():
-            app_files = files[application_code]
-            if not app_files:
+    def iter_image_resizes(self, to_resize, executor=None, max_pending=1):
+        resize_quality = self.api_session_manager.resize_quality
+
+        pending = deque()
+        for file_info, resizes in to_resize:
+            binary = self.get_file_binary(file_info.id).read()
+            if executor is None:
+                yield file_info, make_image_resizes_quietly(binary, resizes, resize_quality)
                 continue
 
-            existing_app_names = existing[application_code]
-            for resize_name in resize_names.keys():
-                for f in app_files:
-                    if f not in existing_app_names or resize_name not in existing_app_names[f]:
-                        self.resize_image(f, application_code, resize_name)
-                        self.flush()
+            # Limit pending images, to keep memory under control
+            pending.append((
+                file_info,
+                executor.submit(make_image_resizes_quietly, binary, resizes, resize_quality)))
+            if len(pending) >= max_pending:
+                file_info, resized = pending.popleft()
+                yield file_info, resized.result()
+
+        while pending:
+            file_info, resized = pending.popleft()
+            yield file_info, resized.result()
 
     @job(second=0, minute=15, hour=2,
          title=_('Compress images'),
@@ -742,6 +1103,8 @@ class FilePath(FilesDeclarative):
 
     id = Column(Integer, primary_key=True)
     code = Column(Unicode(120), unique=True, nullable=False)
+    # Not processed by compress_images while NULL
+    compressed = Column(Boolean)
     compressed_code = Column(Unicode(120))
 
     size = Column(Integer, nullable=False)
@@ -780,6 +1143,7 @@ class BlockPath(FilesDeclarative):
     code = Column(Unicode(120), unique=True, nullable=False)
     path = Column(String(255), nullable=False)
     size = Column(Integer, nullable=False)
+    compression = Column(Unicode(10))
     created_date = Column(DateTime, nullable=False, default=func.now())
 
 
@@ -792,35 +1156,177 @@ class FileBlock(FilesDeclarative):
     order = Column(Integer, nullable=False)
 
 
+class BlocksFoldersAllocator(object):
+    def __init__(self, storage_path, max_blocks_per_folder):
+        self.storage_path = storage_path
+        self.max_blocks_per_folder = max_blocks_per_folder
+        self.lock = Lock()
+        self.process_id = None
+        self.folders = {}
+
+    def allocate(self, base_folder_path):
+        with self.lock:
+            if self.process_id != getpid():
+                # Forked processes cannot share folders
+                self.process_id = getpid()
+                self.folders.clear()
+
+            folder = self.folders.get(base_folder_path)
+            if folder is None or folder[1] >= self.max_blocks_per_folder:
+                folder = self.folders[base_folder_path] = [self.claim_folder(base_folder_path, folder), 0]
+
+            folder[1] += 1
+            return join_paths(base_folder_path, str(folder[0]))
+
+    def claim_folder(self, base_folder_path, last_folder=None):
+        full_base_folder_path = join_paths(self.storage_path, base_folder_path)
+        if last_folder is not None:
+            number = last_folder[0] + 1
+        else:
+            # Only once per day and process
+            make_dir(full_base_folder_path, make_dir_recursively=True)
+            numbers = [int(i) for i in get_dir_filenames(full_base_folder_path) if i.isdigit()]
+            number = numbers and max(numbers) + 1 or 0
+
+        # Folders are owned by the process who creates them, so we can count the blocks
+        while True:
+            try:
+                mkdir(join_paths(full_base_folder_path, str(number)))
+            except FileExistsError:
+                number += 1
+            else:
+                return number
+
+
 class StorageFile(object):
-    def __init__(self, storage_path, name, blocks, block_size=OPEN_BLOCK_SIZE):
+    def __init__(
+            self, storage_path, name, blocks,
+            block_size=OPEN_BLOCK_SIZE,
+            blocks_sizes=None,
+            blocks_compressions=None):
+
         self.storage_path = storage_path
         self.name = name
         self.blocks = blocks
-        self.block_position = 0
         self.block_size = block_size
+        self.position = 0
+
+        self.blocks_sizes = blocks_sizes
+        self.blocks_compressions = blocks_compressions
+        self.open_block = None
+        self.open_block_end = None
+
+    def get_blocks_sizes(self):
+        if self.blocks_sizes is None:
+            self.blocks_sizes = [getsize(join_paths(self.storage_path, path)) for path in self.blocks]
+        return self.blocks_sizes
+
+    @reify
+    def blocks_starts(self):
+        starts = []
+        position = 0
+        for size in self.get_blocks_sizes():
+            starts.append(position)
+            position += size
+        return starts
+
+    @reify
+    def size(self):
+        return sum(self.get_blocks_sizes())
+
+    def open_block_on_position(self):
+        if self.position >= self.size:
+            return None
+
+        index = bisect_right(self.blocks_starts, self.position) - 1
+        open_block = get_open_file(join_paths(self.storage_path, self.blocks[index]))
+
+        compression = self.get_block_compression(index)
+        if compression:
+            # Blocks are small, keep it decompressed in memory
+            compressed_block = open_block
+            try:
+                open_block = BytesIO(decompress_block(compressed_block.read(), compression))
+            finally:
+                compressed_block.close()
+        self.open_block = open_block
+        self.open_block_end = self.blocks_starts[index] + self.blocks_sizes[index]
+
+        block_offset = self.position - self.blocks_starts[index]
+        if block_offset:
+            self.open_block.seek(block_offset)
+        return self.open_block
+
+    def close_block(self):
+        if self.open_block is not None:
+            self.open_block.close()
+            self.open_block = None
+            self.open_block_end = None
 
     def read(self, size=-1):
         if size == 0:
             return b''
 
-        try:
-            open_block = self.blocks[self.block_position]
-        except IndexError:
-            return b''
+        if size is None or size < 0:
+            size = None
 
-        if isinstance(open_block, str):
-            open_block = self.blocks[self.block_position] = get_open_file(join_paths(self.storage_path, open_block))
+        binaries = []
+        while size is None or size > 0:
+            open_block = self.open_block or self.open_block_on_position()
+            if open_block is None:
+                break
 
-        binary = open_block.read(size)
-        if size > 0:
-            size -= len(binary)
-            if size <= 0:
-                return binary
+            binary = open_block.read(size is None and -1 or min(size, self.open_block_end - self.position))
+            if binary:
+                binaries.append(binary)
+                self.position += len(binary)
+                if size is not None:
+                    size -= len(binary)
+
+            if not binary or self.position >= self.open_block_end:
+                # Block consumed
+                if not binary:
+                    # Block file is smaller than expected, go to next block
+                    self.position = self.open_block_end
+                self.close_block()
+
+        return b''.join(binaries)
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        total = 0
+        while total < len(view):
+            open_block = self.open_block or self.open_block_on_position()
+            if open_block is None:
+                break
 
-        self.block_position += 1
-        binary += self.read(size)
-        return binary
+            size = min(len(view) - total, self.open_block_end - self.position)
+            length = open_block.readinto(view[total:total + size])
+            if length:
+                total += length
+                self.position += length
+
+            if not length or self.position >= self.open_block_end:
+                # Block consumed
+                if not length:
+                    # Block file is smaller than expected, go to next block
+                    self.position = self.open_block_end
+                self.close_block()
+
+        return total
+
+    def get_block_compression(self, index):
+        if self.blocks_compressions:
+            return self.blocks_compressions[index]
+
+    def get_single_file(self):
+        # Only one block, the block file is the real file
+        if len(self.blocks) == 1 and not self.get_block_compression(0):
+            open_block = self.open_block or self.open_block_on_position()
+            if open_block is not None:
+                self.open_block = None
+                self.open_block_end = None
+                return open_block
 
     def __iter__(self):
         return self
@@ -834,16 +1340,169 @@ class StorageFile(object):
     __next__ = next  # py3
 
     def close(self):
-        for block in self.blocks:
-            if not isinstance(block, str):
-                block.close()
-
-    def seek(self, position):
-        # @@TODO
-        self.block_position = 0
-        for block in self.blocks:
-            if not isinstance(block, str):
-                block.seek(0)
+        self.close_block()
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            position = offset
+        elif whence == 1:
+            position = self.position + offset
+        elif whence == 2:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence (%s)' % whence)
+
+        if position < 0:
+            raise ValueError('Negative seek position %s' % position)
+
+        if position != self.position:
+            self.close_block()
+            self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+
+def is_compressible_mimetype(mimetype):
+    return not mimetype or not mimetype.startswith(COMPRESSED_MIMETYPES) or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def decompress_block(binary, compression):
+    return CACHE_COMPRESSIONS[compression][2](binary)
+
+
+def iter_storage_folders(storage_path, after_folder=None):
+    after_key = after_folder and get_folder_sort_key(after_folder)
+    for folder_path, folders, filenames in walk(storage_path):
+        # Same order on every run, so we can continue from the last folder
+        folders.sort(key=int_or_string_sort_key)
+
+        if filenames and folder_path != storage_path:
+            folder_path = relpath(folder_path, storage_path)
+            if after_key is None or get_folder_sort_key(folder_path) > after_key:
+                yield folder_path, filenames
+
+
+def int_or_string_sort_key(name):
+    if name.isdigit():
+        return 0, int(name), ''
+    else:
+        return 1, 0, name
+
+
+def get_folder_sort_key(folder_path):
+    return tuple(int_or_string_sort_key(name) for name in folder_path.split(sep))
+
+
+def get_block_sha256(path, compression=None):
+    if not compression:
+        return get_file_sha256(path)
+
+    with open(path, 'rb') as open_file:
+        try:
+            binary = decompress_block(open_file.read(), compression)
+        except Exception:
+            # Corrupted block
+            return None
+    return sha256(binary).hexdigest()
+
+
+def get_file_sha256(path, block_size=OPEN_BLOCK_SIZE):
+    file_hash = sha256()
+    with open(path, 'rb') as open_file:
+        for chunk in iter_file_chunks(open_file, block_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def add_to_scrub_report(report, key, path, max_paths=1000):
+    if len(report[key]) < max_paths:
+        report[key].append(path)
+
+
+def get_resize_scale(width, height, resize_width, resize_height):
+    if not resize_width:
+        return resize_height / float(height)
+    elif not resize_height:
+        return resize_width / float(width)
+    else:
+        return max(resize_width / float(width), resize_height / float(height))
+
+
+def resize_image_object(im, resize_width, resize_height, resize_quality):
+    width = int(im.size[0])
+    height = int(im.size[1])
+
+    if not resize_width:
+        resize_width = ceil((float(width) * resize_height) / height)
+
+    elif not resize_height:
+        resize_height = ceil((float(resize_width) * height) / width)
+
+    else:
+        resize_racio = resize_width / float(resize_height)
+        image_racio = width / float(height)
+
+        if image_racio < resize_racio:
+            # Crop image on height
+            crop_size = ceil(round(height - (width / resize_racio)) / 2)
+            lower_position = int(height - int(crop_size))
+            # Crop as left, upper, right, and lower pixel
+            im = im.crop((0, int(crop_size), width, lower_position))
+
+        elif image_racio > resize_racio:
+            crop_size = ceil(round(width - (height * resize_racio)) / 2)
+            right_position = int(width - int(crop_size))
+            # Crop as left, upper, right, and lower pixel
+            im = im.crop((int(crop_size), 0, right_position, height))
+
+    return im.resize((int(resize_width), int(resize_height)), resize_quality)
+
+
+def make_image_resizes(binary, resizes, resize_quality):
+    im = lazy_import_module('PIL.Image').open(BytesIO(binary))
+    width = int(im.size[0])
+    height = int(im.size[1])
+
+    # Decode only what we need for the biggest resize
+    scale = max(
+        get_resize_scale(width, height, resize_width, resize_height)
+        for resize_width, resize_height in resizes.values())
+    if scale < 1 and im.format == 'JPEG':
+        im.draft(im.mode, (int(ceil(width * scale)), int(ceil(height * scale))))
+    elif scale <= 0.5 and im.mode in ('L', 'RGB', 'RGBA') and hasattr(im, 'reduce'):
+        im = im.reduce(int(1 / scale))
+
+    response = {}
+    for resize_name, (resize_width, resize_height) in resizes.items():
+        resized = resize_image_object(im, resize_width, resize_height, resize_quality)
+        response[resize_name] = save_image_binary(resized)
+    return response
+
+
+def make_image_resizes_quietly(binary, resizes, resize_quality):
+    # One invalid image should not stop the others
+    try:
+        return make_image_resizes(binary, resizes, resize_quality)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_image_binary(im, default_format='JPEG'):
+    open_file = BytesIO()
+    try:
+        im.save(open_file, format=im.format or default_format, optimize=True)
+    except IOError as error:
+        if error.args[0] == 'cannot write mode P as JPEG':
+            open_file = BytesIO()
+            im.convert('RGB').save(open_file, format=im.format or default_format, optimize=True)
+        else:
+            raise
+    return open_file.getvalue()
 
 
 def create_temporary_file(mode='wb'):
@@ -1,27 +1,324 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict, OrderedDict
+import datetime
+from decimal import Decimal
+import errno
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
 from functools import lru_cache, wraps
-from os.path import isfile, join as join_paths
-from pickle import dumps as pickle_dumps, loads as pickle_loads
+from inspect import signature
+from math import log
+from marshal import dumps as marshal_dumps, loads as marshal_loads
+from mmap import mmap
+from os import close as os_close, getpid, O_CREAT, O_RDWR, open as os_open, pread, pwrite
+from os.path import dirname, isfile, join as join_paths
+from pickle import dumps as pickle_dumps, HIGHEST_PROTOCOL, loads as pickle_loads
+from random import random
+from struct import Struct
+from threading import Lock, RLock
+from time import time
+from zlib import compress as zlib_compress, crc32, decompress as zlib_decompress, error as zlib_error
+
+from pyramid.settings import asbool
 
 from ines import DEFAULT_RETRY_ERRNO, lazy_import_module, MARKER, NEW_LINE_AS_BYTES, NOW_TIME
 from ines.cleaner import clean_string
-from ines.convert import make_sha256, maybe_integer, maybe_list, maybe_set, to_bytes
-from ines.locks import LockMe, LockMeMemcached
+from ines.convert import make_sha256, maybe_integer, maybe_list, maybe_set, to_bytes, to_string
+from ines.exceptions import LockTimeout
+from ines.locks import LockMe, LockMeFlock, LockMeMemcached
+from ines.request import make_request
+from ines.system import register_after_fork, start_system_thread, thread_is_running
 from ines.utils import (
-    file_modified_time, get_file_binary, make_dir, make_uuid_hash, move_file, put_binary_on_file, remove_file_quietly)
+    file_modified_time, file_stat, get_dir_filenames, get_file_binary, make_dir, make_uuid_hash, move_file,
+    put_binary_on_file, remove_file_quietly)
+
+
+SEGMENT_MAGIC = b'INES'
+SEGMENT_FILENAME = 'segment-%010d'
+SEGMENT_COMPACT_FILENAME = 'compact-%010d'
+# magic, superseded, capacity, used slots, items, dead bytes, last segment number, last segment end
+SEGMENT_INDEX_HEADER = Struct('>4sIIIIQQQ')
+SEGMENT_INDEX_HEADER_SIZE = 64
+SEGMENT_INDEX_SUPERSEDED = Struct('>I')
+SEGMENT_INDEX_LOAD = 0.7
+# key hash, segment number, record offset, record size
+SEGMENT_INDEX_SLOT = Struct('>QIQI')
+# flags, key length, value length, created time, expire time, crc32 of key + value
+SEGMENT_RECORD_HEADER = Struct('>BIIIII')
+SEGMENT_RECORD_DELETED = 1
+
+# api_cache_decorator values are saved as: marker, created time, compute seconds, value
+API_CACHE_DECORATOR_ENTRY = 'ines.api_cache_decorator entry'
+# Arguments types with a stable repr, used to build cache keys
+API_CACHE_ARGUMENTS_TYPES = (str, int, float, Decimal, datetime.date, datetime.time, datetime.timedelta)
+
+# Values are saved as: magic, serializer code, compression code, data
+# Values saved without this header are pickle dumps
+CACHE_HEADER_MAGIC = b'\xc1'
+CACHE_HEADER_SIZE = 3
+PICKLE_PROTOCOL = min(5, HIGHEST_PROTOCOL)
+
+
+def pickle_dumps_with_protocol(value):
+    return pickle_dumps(value, protocol=PICKLE_PROTOCOL)
+
+
+def msgpack_dumps(value):
+    return lazy_import_module('msgpack').packb(value, use_bin_type=True)
+
+
+def msgpack_loads(binary):
+    return lazy_import_module('msgpack').unpackb(binary, raw=False)
+
+
+def zlib_compress_with_level(binary, level=None):
+    if level is None:
+        return zlib_compress(binary)
+    else:
+        return zlib_compress(binary, level)
+
+
+def lz4_compress(binary, level=None):
+    return lazy_import_module('lz4.frame').compress(binary, compression_level=level or 0)
+
+
+def lz4_decompress(binary):
+    return lazy_import_module('lz4.frame').decompress(binary)
+
+
+# name: (code, dumps, loads)
+CACHE_SERIALIZERS = {
+    'pickle': (1, pickle_dumps_with_protocol, pickle_loads),
+    'marshal': (2, marshal_dumps, marshal_loads),
+    'msgpack': (3, msgpack_dumps, msgpack_loads)}
+
+# name: (code, compress, decompress, module to validate)
+CACHE_COMPRESSIONS = {
+    'zlib': (1, zlib_compress_with_level, zlib_decompress, None),
+    'lz4': (2, lz4_compress, lz4_decompress, 'lz4.frame')}
+
+CACHE_LOADS_BY_CODE = {code: loads for code, dumps, loads in CACHE_SERIALIZERS.values()}
+CACHE_DECOMPRESS_BY_CODE = {code: decompress for code, compress, decompress, module in CACHE_COMPRESSIONS.values()}
+
+
+class CacheSerializer(object):
+    def __init__(self, serializer=None, compression=None, compression_min_size=None, compression_level=None):
+        serializer = serializer or 'pickle'
+        if serializer not in CACHE_SERIALIZERS:
+            raise ValueError('Invalid cache serializer "%s"' % serializer)
+        elif serializer == 'msgpack':
+            lazy_import_module('msgpack')
+
+        self.serializer = serializer
+        self.serializer_code, self.serializer_dumps, serializer_loads = CACHE_SERIALIZERS[serializer]
+
+        self.compression = compression or None
+        if self.compression:
+            if self.compression not in CACHE_COMPRESSIONS:
+                raise ValueError('Invalid cache compression "%s"' % self.compression)
+
+            self.compression_code, self.compress, decompress, module_name = CACHE_COMPRESSIONS[self.compression]
+            if module_name:
+                lazy_import_module(module_name)
+        else:
+            self.compression_code = 0
+            self.compress = None
+
+        compression_min_size = maybe_integer(compression_min_size)
+        if compression_min_size is None:
+            compression_min_size = 1024
+        self.compression_min_size = compression_min_size
+        self.compression_level = maybe_integer(compression_level)
+
+    def dumps(self, value):
+        binary = self.serializer_dumps(value)
+
+        compression_code = 0
+        if self.compress is not None and len(binary) >= self.compression_min_size:
+            compressed = self.compress(binary, self.compression_level)
+            if len(compressed) < len(binary):
+                binary = compressed
+                compression_code = self.compression_code
+
+        return CACHE_HEADER_MAGIC + bytes((self.serializer_code, compression_code)) + binary
+
+    def loads(self, binary):
+        if binary[:1] != CACHE_HEADER_MAGIC:
+            # Saved before headers
+            return pickle_loads(binary)
+        elif len(binary) < CACHE_HEADER_SIZE:
+            raise EOFError('Invalid cache header')
+
+        serializer_code = binary[1]
+        compression_code = binary[2]
+        binary = binary[CACHE_HEADER_SIZE:]
+
+        if compression_code:
+            decompress = CACHE_DECOMPRESS_BY_CODE.get(compression_code)
+            if decompress is None:
+                raise ValueError('Invalid cache compression code "%s"' % compression_code)
+
+            try:
+                binary = decompress(binary)
+            except (zlib_error, RuntimeError) as error:
+                raise EOFError('Invalid compressed cache value: %s' % error)
+
+        loads = CACHE_LOADS_BY_CODE.get(serializer_code)
+        if loads is None:
+            raise ValueError('Invalid cache serializer code "%s"' % serializer_code)
+        else:
+            return loads(binary)
+
+
+DEFAULT_CACHE_SERIALIZER = CacheSerializer()
+
+
+class MemoryLRU(object):
+    def __init__(self, max_size, share_values=False, loads=pickle_loads):
+        self.max_size = int(max_size)
+        self.share_values = share_values
+        self.loads = loads
+        self.size = 0
+        self.values = OrderedDict()
+        self.thread_lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, name, version):
+        with self.thread_lock:
+            item = self.values.get(name)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return MARKER
+
+            self.values.move_to_end(name)
+            self.hits += 1
+
+        if self.share_values:
+            return item[2]
+        else:
+            # Give a private copy, callers may change the value
+            return self.loads(item[1])
+
+    def put(self, name, version, binary, value):
+        size = len(binary)
+        if size > self.max_size:
+            return self.remove(name)
+
+        if not self.share_values:
+            # Value is always loaded from binary, no need to keep it
+            value = None
+
+        with self.thread_lock:
+            existing = self.values.pop(name, None)
+            if existing is not None:
+                self.size -= len(existing[1])
+
+            self.values[name] = (version, binary, value)
+            self.size += size
+
+            while self.size > self.max_size:
+                old_name, (old_version, old_binary, old_value) = self.values.popitem(last=False)
+                self.size -= len(old_binary)
+                self.evictions += 1
+
+    def remove(self, name):
+        with self.thread_lock:
+            existing = self.values.pop(name, None)
+            if existing is not None:
+                self.size -= len(existing[1])
+
+    def clear(self):
+        with self.thread_lock:
+            self.values.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'items': len(self.values),
+            'size': self.size,
+            'max_size': self.max_size}
+
+
+def make_lockme(path, **settings):
+    if settings.pop('type', None) == 'flock':
+        return LockMeFlock(path, **settings)
+    else:
+        return LockMe(path, **settings)
 
 
 class _SaveMe(object):
+    memory = None
+    serializer = DEFAULT_CACHE_SERIALIZER
+
+    def set_memory(self, memory_size=None, memory_share_values=False):
+        memory_size = maybe_integer(memory_size)
+        if memory_size:
+            self.memory = MemoryLRU(memory_size, share_values=asbool(memory_share_values), loads=self.loads)
+        else:
+            self.memory = None
+
+    def set_serializer(self, serializer=None, compression=None, compression_min_size=None, compression_level=None):
+        if serializer or compression:
+            self.serializer = CacheSerializer(
+                serializer,
+                compression=compression,
+                compression_min_size=compression_min_size,
+                compression_level=compression_level)
+        else:
+            self.serializer = DEFAULT_CACHE_SERIALIZER
+
+    def dumps(self, value):
+        return self.serializer.dumps(value)
+
+    def loads(self, binary):
+        return self.serializer.loads(binary)
+
+    def get_version(self, name, expire=MARKER):
+        pass
+
+    def get_versions(self, names, expire=MARKER):
+        versions = {}
+        for name in names:
+            version = self.get_version(name, expire=expire)
+            if version is not None:
+                versions[name] = version
+        return versions
+
     def get_binary(self, name, expire=MARKER):
         pass
 
+    def get_binary_many(self, names, expire=MARKER):
+        binaries = {}
+        for name in names:
+            try:
+                binaries[name] = self.get_binary(name, expire=expire)
+            except KeyError:
+                pass
+        return binaries
+
     def put_binary(self, name, binary, mode='put', expire=MARKER):
         pass
 
+    def put_binary_many(self, binaries, expire=MARKER):
+        for name, binary in binaries.items():
+            self.put_binary(name, binary, expire=expire)
+
     def __delitem__(self, name):
         pass
 
+    def delete_binary_many(self, names):
+        for name in names:
+            del self[name]
+
     def __contains__(self, name):
         pass
 
@@ -64,26 +361,98 @@ class _SaveMe(object):
         self.put(name, info)
 
     def get(self, name, default=None, expire=MARKER):
+        version = None
+        if self.memory is not None:
+            # Version must be read before the binary, so we never keep a newer version with an older binary
+            version = self.get_version(name, expire=expire)
+            if version is None:
+                self.memory.remove(name)
+            else:
+                value = self.memory.get(name, version)
+                if value is not MARKER:
+                    return value
+
         try:
             binary = self.get_binary(name, expire=expire)
         except KeyError:
             return default
         else:
             try:
-                value = pickle_loads(binary)
+                value = self.loads(binary)
             except EOFError:
                 # Something goes wrong! Delete file to prevent more errors
                 self.remove(name)
                 raise
             else:
+                if version is not None:
+                    self.memory.put(name, version, binary, value)
                 return value
 
     def put(self, name, info, expire=MARKER):
-        info = pickle_dumps(info)
+        info = self.dumps(info)
         self.put_binary(name, info, expire=expire)
+        if self.memory is not None:
+            self.memory.remove(name)
 
     def remove(self, name):
         del self[name]
+        if self.memory is not None:
+            self.memory.remove(name)
+
+    def get_many(self, names, expire=MARKER):
+        names = maybe_set(names)
+        values = {}
+
+        versions = {}
+        if self.memory is not None:
+            versions = self.get_versions(names, expire=expire)
+            for name in names:
+                version = versions.get(name)
+                if version is None:
+                    self.memory.remove(name)
+                else:
+                    value = self.memory.get(name, version)
+                    if value is not MARKER:
+                        values[name] = value
+
+        missing_names = names.difference(values.keys())
+        if missing_names:
+            for name, binary in self.get_binary_many(missing_names, expire=expire).items():
+                try:
+                    value = self.loads(binary)
+                except EOFError:
+                    # Something goes wrong! Delete file to prevent more errors
+                    self.remove(name)
+                    raise
+                else:
+                    values[name] = value
+                    version = versions.get(name)
+                    if version is not None:
+                        self.memory.put(name, version, binary, value)
+
+        return values
+
+    def put_many(self, values, expire=MARKER):
+        if not values:
+            return None
+
+        self.put_binary_many(
+            {name: self.dumps(info) for name, info in values.items()},
+            expire=expire)
+
+        if self.memory is not None:
+            for name in values.keys():
+                self.memory.remove(name)
+
+    def delete_many(self, names):
+        names = maybe_set(names)
+        if not names:
+            return None
+
+        self.delete_binary_many(names)
+        if self.memory is not None:
+            for name in names:
+                self.memory.remove(name)
 
 
 class SaveMe(_SaveMe):
@@ -93,6 +462,12 @@ class SaveMe(_SaveMe):
             expire=None,
             retry_errno=None,
             retries=3,
+            memory_size=None,
+            memory_share_values=False,
+            serializer=None,
+            compression=None,
+            compression_min_size=None,
+            compression_level=None,
             **lock_settings):
 
         self.expire = maybe_integer(expire)
@@ -100,6 +475,8 @@ class SaveMe(_SaveMe):
         self.retries = maybe_integer(retries) or 3
         self.retry_errno = maybe_set(retry_errno)
         self.retry_errno.update(DEFAULT_RETRY_ERRNO)
+        self.set_memory(memory_size, memory_share_values)
+        self.set_serializer(serializer, compression, compression_min_size, compression_level)
 
         # Lock settings
         settings = {}
@@ -108,7 +485,7 @@ class SaveMe(_SaveMe):
                 settings[key.split('lock_', 1)[1]] = value
 
         lock_path = settings.pop('path', None) or join_paths(self.path, 'locks')
-        self.lockme = LockMe(lock_path, **settings)
+        self.lockme = make_lockme(lock_path, **settings)
 
     def lock(self, *args, **kwargs):
         return self.lockme.lock(*args, **kwargs)
@@ -116,6 +493,15 @@ class SaveMe(_SaveMe):
     def unlock(self, *args, **kwargs):
         return self.lockme.unlock(*args, **kwargs)
 
+    def lock_many(self, *args, **kwargs):
+        return self.lockme.lock_many(*args, **kwargs)
+
+    def unlock_many(self, *args, **kwargs):
+        return self.lockme.unlock_many(*args, **kwargs)
+
+    def locked(self, *args, **kwargs):
+        return self.lockme.locked(*args, **kwargs)
+
     @lru_cache(1000)
     def get_file_path(self, name):
         name_256 = make_sha256(name)
@@ -138,6 +524,19 @@ class SaveMe(_SaveMe):
     def __contains__(self, name):
         return self._contains(self.get_file_path(name))
 
+    def get_version(self, name, expire=MARKER):
+        stat = file_stat(self.get_file_path(name), retries=self.retries, retry_errno=self.retry_errno)
+        if stat is None:
+            return None
+
+        if expire is MARKER:
+            expire = self.expire
+        if expire and (stat.st_mtime + int(expire)) < NOW_TIME():
+            return None
+
+        # Other processes can rewrite the file in the same mtime tick, so size and inode are also compared
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
     def _get_binary(self, path, expire=MARKER):
         if expire is MARKER:
             expire = self.expire
@@ -158,9 +557,28 @@ class SaveMe(_SaveMe):
         else:
             return binary
 
+    def _put_binary(self, path, binary):
+        # Readers never see a half written file, no need to lock them
+        temporary_path = '%s.%s' % (path, make_uuid_hash())
+        put_binary_on_file(temporary_path, binary, 'wb', retries=self.retries, retry_errno=self.retry_errno)
+        move_file(temporary_path, path, retries=self.retries, retry_errno=self.retry_errno)
+
     def put_binary(self, name, binary, mode='put', expire=MARKER):
-        mode = 'ab' if mode == 'append' else 'wb'
-        put_binary_on_file(self.get_file_path(name), binary, mode, retries=self.retries, retry_errno=self.retry_errno)
+        path = self.get_file_path(name)
+        if mode == 'append':
+            put_binary_on_file(path, binary, 'ab', retries=self.retries, retry_errno=self.retry_errno)
+        else:
+            self._put_binary(path, binary)
+
+    def put_binary_many(self, binaries, expire=MARKER):
+        paths = {name: self.get_file_path(name) for name in binaries.keys()}
+
+        # Create each folder only once, instead of one failed open per file
+        for folder_path in set(dirname(path) for path in paths.values()):
+            make_dir(folder_path)
+
+        for name, binary in binaries.items():
+            self._put_binary(paths[name], binary)
 
     def _delete_path(self, path):
         remove_file_quietly(path, retries=self.retries, retry_errno=self.retry_errno)
@@ -169,6 +587,10 @@ class SaveMe(_SaveMe):
         file_path = self.get_file_path(name)
         self._delete_path(file_path)
 
+    def delete_binary_many(self, names):
+        for path in set(self.get_file_path(name) for name in names):
+            self._delete_path(path)
+
 
 class SaveMeWithReference(SaveMe):
     def __init__(self, *args, **kwargs):
@@ -179,102 +601,664 @@ class SaveMeWithReference(SaveMe):
         super(SaveMeWithReference, self).put_binary(name, *args, **kwargs)
         self.put_reference(name)
 
+    def put_binary_many(self, binaries, expire=MARKER):
+        super(SaveMeWithReference, self).put_binary_many(binaries, expire=expire)
+        self.put_references(binaries.keys())
+
     def __delitem__(self, name):
         super(SaveMeWithReference, self).__delitem__(name)
         self.remove_reference(name)
 
+    def delete_binary_many(self, names):
+        super(SaveMeWithReference, self).delete_binary_many(names)
+        self.remove_references(names)
+
     def get_reference_path(self, name):
-        first_name = name.split(' ', 1)[0]
+        first_name = to_string(name).split(' ', 1)[0]
         first_name_256 = make_sha256(first_name)
         return join_paths(self.reference_path, first_name_256[0], first_name_256)
 
+    def group_by_reference_path(self, names):
+        references = defaultdict(set)
+        for name in names:
+            references[self.get_reference_path(name)].add(name)
+        return references
+
     def _get_references(self, path, name):
         references = set()
         binary = self._get_binary(path, expire=None)
         if binary is not None:
             for saved_name in binary.splitlines():
-                if saved_name and saved_name.startswith(name):
-                    references.add(saved_name)
+                if saved_name:
+                    saved_name = to_string(saved_name)
+                    if saved_name.startswith(name):
+                        references.add(saved_name)
         return references
 
     def get_references(self, name):
+        name = to_string(name)
         file_path = self.get_reference_path(name)
         return self._get_references(file_path, name)
 
     def put_reference(self, name):
-        if name not in self.get_references(name):
-            put_binary_on_file(
-                self.get_reference_path(name),
-                NEW_LINE_AS_BYTES.join([to_bytes(name), b'']),
-                mode='ab',
-                retries=self.retries,
-                retry_errno=self.retry_errno)
-
-    def remove_reference(self, name, expire=MARKER):
-        file_path = self.get_reference_path(name)
-        temporary_file_path = file_path + '.' + make_uuid_hash()
-        move_file(file_path, temporary_file_path, retries=self.retries, retry_errno=self.retry_errno)
-
-        references = self._get_references(temporary_file_path, name='')
-        if name in references:
-            references.remove(name)
-
-        # Validate if references still exists
-        if references:
-            if expire is MARKER:
-                # Dont use expire, we only need to know if file exists
-                expire = None
-            for name in references:
-                path = self.get_file_path(name)
-                if not self._contains(path, expire=expire):
-                    references.remove(name)
+        self.put_references([name])
 
-            if references:
-                references = maybe_list(references)
-                references.append(NEW_LINE_AS_BYTES)
+    def put_references(self, names):
+        for file_path, path_names in self.group_by_reference_path(map(to_string, names)).items():
+            path_names.difference_update(self._get_references(file_path, name=''))
+            if path_names:
+                path_names = maybe_list(path_names)
+                path_names.append('')
 
                 put_binary_on_file(
                     file_path,
-                    binary=NEW_LINE_AS_BYTES.join(map(to_bytes, references)),
+                    NEW_LINE_AS_BYTES.join(map(to_bytes, path_names)),
                     mode='ab',
                     retries=self.retries,
                     retry_errno=self.retry_errno)
 
-        self._delete_path(temporary_file_path)
+    def remove_reference(self, name, expire=MARKER):
+        self.remove_references([name], expire=expire)
+
+    def remove_references(self, names, expire=MARKER):
+        for file_path, path_names in self.group_by_reference_path(map(to_string, names)).items():
+            temporary_file_path = file_path + '.' + make_uuid_hash()
+            try:
+                move_file(file_path, temporary_file_path, retries=self.retries, retry_errno=self.retry_errno)
+            except OSError as error:
+                if error.errno is errno.ENOENT:
+                    # No references saved
+                    continue
+                raise
+
+            references = self._get_references(temporary_file_path, name='')
+            references.difference_update(path_names)
+
+            # Validate if references still exists
+            if references:
+                if expire is MARKER:
+                    # Dont use expire, we only need to know if file exists
+                    expire = None
+                references = set(
+                    reference
+                    for reference in references
+                    if self._contains(self.get_file_path(reference), expire=expire))
+
+                if references:
+                    references = maybe_list(references)
+                    references.append('')
+
+                    put_binary_on_file(
+                        file_path,
+                        binary=NEW_LINE_AS_BYTES.join(map(to_bytes, references)),
+                        mode='ab',
+                        retries=self.retries,
+                        retry_errno=self.retry_errno)
+
+            self._delete_path(temporary_file_path)
 
     def get_children(self, name, expire=MARKER):
-        result = {}
-        missing_reference = False
-        for reference in self.get_references(name):
-            value = self.get(reference, MARKER, expire=expire)
-            if value is not MARKER:
-                result[reference] = value
-            else:
-                missing_reference = True
+        references = self.get_references(name)
+        if not references:
+            return {}
 
-        if missing_reference:
-            self.remove_reference(name, expire)
+        result = self.get_many(references, expire=expire)
+        if len(result) != len(references):
+            # Some references are missing
+            self.remove_references(references.difference(result.keys()), expire)
 
         return result
 
     def remove_children(self, name):
-        for reference in self.get_references(name):
-            self.remove(reference)
+        references = self.get_references(name)
+        if references:
+            self.delete_many(references)
 
     def __contains__(self, name):
         file_path = self.get_reference_path(name)
         binary = self._get_binary(file_path, expire=None)
         if binary is not None:
-            return name in binary.splitlines()
+            return to_bytes(name) in binary.splitlines()
+        else:
+            return False
+
+
+class SaveMeSegments(_SaveMe):
+    def __init__(
+            self,
+            path,
+            expire=None,
+            segment_size=2**26,
+            index_capacity=2**16,
+            compact_ratio=0.5,
+            compact_interval=300,
+            memory_size=None,
+            memory_share_values=False,
+            serializer=None,
+            compression=None,
+            compression_min_size=None,
+            compression_level=None,
+            **lock_settings):
+
+        self.expire = maybe_integer(expire)
+        self.path = make_dir(path)
+        self.segment_size = maybe_integer(segment_size) or 2**26
+        self.index_capacity = maybe_integer(index_capacity) or 2**16
+        self.compact_ratio = float(compact_ratio or 0.5)
+        self.set_memory(memory_size, memory_share_values)
+        self.set_serializer(serializer, compression, compression_min_size, compression_level)
+
+        self.index = None
+        self.index_path = join_paths(self.path, 'index')
+        self.segments_fds = {}
+        self.thread_lock = RLock()
+        self.write_lock_path = join_paths(self.path, 'write.lock')
+        self.write_lock_fd = None
+        self.process_id = None
+        self.compact_lock_path = join_paths(self.path, 'compact.lock')
+        self.compact_interval = maybe_integer(compact_interval)
+
+        # Lock settings
+        settings = {}
+        for key, value in list(lock_settings.items()):
+            if key.startswith('lock_'):
+                settings[key.split('lock_', 1)[1]] = value
+
+        lock_path = settings.pop('path', None) or join_paths(self.path, 'locks')
+        self.lockme = make_lockme(lock_path, **settings)
+
+        self.open_index()
+
+        if self.compact_interval:
+            self.start_compact_daemon()
+            # Threads are not copied to forked processes
+            register_after_fork(self.start_compact_daemon)
+
+    def lock(self, *args, **kwargs):
+        return self.lockme.lock(*args, **kwargs)
+
+    def unlock(self, *args, **kwargs):
+        return self.lockme.unlock(*args, **kwargs)
+
+    def lock_many(self, *args, **kwargs):
+        return self.lockme.lock_many(*args, **kwargs)
+
+    def unlock_many(self, *args, **kwargs):
+        return self.lockme.unlock_many(*args, **kwargs)
+
+    def locked(self, *args, **kwargs):
+        return self.lockme.locked(*args, **kwargs)
+
+    def lock_writes(self):
+        self.thread_lock.acquire()
+        try:
+            if self.process_id != getpid():
+                # flock is shared by forked processes, each process needs his own file descriptor
+                self.process_id = getpid()
+                self.write_lock_fd = os_open(self.write_lock_path, O_RDWR | O_CREAT, 0o666)
+            flock(self.write_lock_fd, LOCK_EX)
+        except:
+            self.thread_lock.release()
+            raise
+
+    def unlock_writes(self):
+        try:
+            flock(self.write_lock_fd, LOCK_UN)
+        finally:
+            self.thread_lock.release()
+
+    def start_compact_daemon(self):
+        thread_name = 'cache_segments_compact %s' % self.path
+        if not thread_is_running(thread_name):
+            start_system_thread(thread_name, self.compact_daemon, args=[self.compact_interval])
+
+    def get_segment_path(self, number):
+        return join_paths(self.path, SEGMENT_FILENAME % number)
+
+    def get_segment_numbers(self):
+        numbers = []
+        for filename in get_dir_filenames(self.path):
+            if filename.startswith('segment-'):
+                number = maybe_integer(filename.split('-', 1)[1])
+                if number:
+                    numbers.append(number)
+        return sorted(numbers)
+
+    def get_segment_fd(self, number, create=False):
+        fd = self.segments_fds.get(number)
+        if fd is None:
+            try:
+                fd = os_open(self.get_segment_path(number), create and (O_RDWR | O_CREAT) or O_RDWR, 0o666)
+            except OSError as error:
+                if error.errno is errno.ENOENT:
+                    return None
+                raise
+            self.segments_fds[number] = fd
+        return fd
+
+    def close_segments_fds(self, until_number=None):
+        for number, fd in list(self.segments_fds.items()):
+            if until_number is None or number <= until_number:
+                self.segments_fds.pop(number)
+                os_close(fd)
+
+    def open_index(self):
+        self.lock_writes()
+        try:
+            stat = file_stat(self.index_path)
+            if stat is None or stat.st_size < SEGMENT_INDEX_HEADER_SIZE:
+                # Missing index, rebuild with existing segments
+                self.replace_index(*self.scan_segments())
+            else:
+                self.map_index()
+        finally:
+            self.unlock_writes()
+
+    def map_index(self):
+        # Called with thread lock
+        if self.index is not None:
+            self.index.close()
+        self.close_segments_fds()
+
+        fd = os_open(self.index_path, O_RDWR)
+        try:
+            self.index = mmap(fd, 0)
+        finally:
+            os_close(fd)
+
+    def check_index(self):
+        # Called with thread lock
+        if SEGMENT_INDEX_SUPERSEDED.unpack_from(self.index, 4)[0]:
+            self.map_index()
+
+    def read_index_header(self):
+        return list(SEGMENT_INDEX_HEADER.unpack_from(self.index, 0))
+
+    def write_index_header(self, header):
+        SEGMENT_INDEX_HEADER.pack_into(self.index, 0, *header)
+
+    def read_slot(self, position):
+        return SEGMENT_INDEX_SLOT.unpack_from(
+            self.index,
+            SEGMENT_INDEX_HEADER_SIZE + position * SEGMENT_INDEX_SLOT.size)
+
+    def write_slot(self, position, *slot):
+        SEGMENT_INDEX_SLOT.pack_into(
+            self.index,
+            SEGMENT_INDEX_HEADER_SIZE + position * SEGMENT_INDEX_SLOT.size,
+            *slot)
+
+    def read_record(self, number, offset, size, key_length=None):
+        fd = self.get_segment_fd(number)
+        if fd is None:
+            return None
+        elif key_length is None:
+            return parse_segment_record(pread(fd, size, offset))
+
+        # Only header and key, used to validate versions
+        binary = pread(fd, SEGMENT_RECORD_HEADER.size + key_length, offset)
+        if len(binary) == (SEGMENT_RECORD_HEADER.size + key_length):
+            flags, record_key_length, value_length, created_time, expire_time, crc = (
+                SEGMENT_RECORD_HEADER.unpack_from(binary))
+            if record_key_length == key_length:
+                return flags, binary[SEGMENT_RECORD_HEADER.size:], None, created_time, expire_time
+
+    def find_slot(self, key, read_value=True):
+        # Called with thread lock
+        key_hash = make_segment_key_hash(key)
+        capacity = SEGMENT_INDEX_HEADER.unpack_from(self.index, 0)[2]
+        position = key_hash % capacity
+        free_position = None
+
+        for i in range(capacity):
+            slot_hash, number, offset, size = self.read_slot(position)
+            if not slot_hash:
+                if free_position is None:
+                    free_position = position
+                break
+
+            elif not number:
+                # Deleted slot, can be used by new keys
+                if free_position is None:
+                    free_position = position
+
+            elif slot_hash == key_hash:
+                record = self.read_record(number, offset, size, key_length=not read_value and len(key) or None)
+                if record is not None and record[1] == key:
+                    return position, (number, offset, size), record
+
+            position = (position + 1) % capacity
+
+        return free_position, None, None
+
+    def record_expired(self, record, expire=MARKER):
+        flags, key, value, created_time, expire_time = record
+        if flags & SEGMENT_RECORD_DELETED:
+            return True
+        elif expire is MARKER:
+            return bool(expire_time and expire_time < NOW_TIME())
+        elif expire:
+            return (created_time + int(expire)) < NOW_TIME()
         else:
             return False
 
+    def write_record(self, key, value, flags=0, expire_time=0):
+        # Called with write lock
+        header = self.read_index_header()
+        if (header[3] + 1) > (header[2] * SEGMENT_INDEX_LOAD):
+            # Index is almost full, grow it
+            self.rewrite_index()
+            header = self.read_index_header()
+
+        magic, superseded, capacity, used, items, dead_bytes, number, end = header
+        position, slot, record = self.find_slot(key, read_value=False)
+        deleted = flags & SEGMENT_RECORD_DELETED
+        if deleted and slot is None:
+            return False
+
+        if not number or end >= self.segment_size:
+            number += 1
+            end = 0
+
+        # One write for each record, an incomplete record is overwritten by the next one
+        binary = build_segment_record(key, value, flags, NOW_TIME(), expire_time)
+        pwrite(self.get_segment_fd(number, create=True), binary, end)
+        size = len(binary)
+
+        key_hash = make_segment_key_hash(key)
+        if slot is not None:
+            dead_bytes += slot[2]
+        elif not self.read_slot(position)[0]:
+            used += 1
+
+        if deleted:
+            dead_bytes += size
+            items -= 1
+            self.write_slot(position, key_hash, 0, 0, 0)
+        else:
+            if slot is None:
+                items += 1
+            self.write_slot(position, key_hash, number, end, size)
+
+        self.write_index_header((magic, superseded, capacity, used, items, dead_bytes, number, end + size))
+        return True
+
+    def iter_live_slots(self):
+        # Called with thread lock
+        capacity = self.read_index_header()[2]
+        for position in range(capacity):
+            slot_hash, number, offset, size = self.read_slot(position)
+            if number:
+                yield slot_hash, (number, offset, size)
+
+    def rewrite_index(self):
+        # Called with write lock
+        magic, superseded, capacity, used, items, dead_bytes, number, end = self.read_index_header()
+        self.replace_index(list(self.iter_live_slots()), number, end, dead_bytes)
+
+    def replace_index(self, entries, number, end, dead_bytes):
+        # Called with write lock
+        # entries: list of (key hash, (segment number, record offset, record size))
+        capacity = self.index_capacity
+        while (len(entries) / SEGMENT_INDEX_LOAD) * 2 > capacity:
+            capacity *= 2
+
+        index = bytearray(SEGMENT_INDEX_HEADER_SIZE + capacity * SEGMENT_INDEX_SLOT.size)
+        for key_hash, (slot_number, offset, size) in entries:
+            position = key_hash % capacity
+            while SEGMENT_INDEX_SLOT.unpack_from(
+                    index,
+                    SEGMENT_INDEX_HEADER_SIZE + position * SEGMENT_INDEX_SLOT.size)[0]:
+                position = (position + 1) % capacity
+
+            SEGMENT_INDEX_SLOT.pack_into(
+                index,
+                SEGMENT_INDEX_HEADER_SIZE + position * SEGMENT_INDEX_SLOT.size,
+                key_hash, slot_number, offset, size)
+
+        SEGMENT_INDEX_HEADER.pack_into(
+            index, 0,
+            SEGMENT_MAGIC, 0, capacity, len(entries), len(entries), dead_bytes, number, end)
+
+        temporary_path = '%s.%s' % (self.index_path, make_uuid_hash())
+        put_binary_on_file(temporary_path, bytes(index))
+        move_file(temporary_path, self.index_path)
+
+        if self.index is not None:
+            # Other processes will open the new index on next access
+            SEGMENT_INDEX_SUPERSEDED.pack_into(self.index, 4, 1)
+        self.map_index()
+
+    def scan_segments(self):
+        # Called with write lock
+        entries = {}
+        dead_bytes = last_number = last_end = 0
+
+        for number in self.get_segment_numbers():
+            fd = self.get_segment_fd(number)
+            offset = 0
+            while True:
+                header = pread(fd, SEGMENT_RECORD_HEADER.size, offset)
+                if len(header) < SEGMENT_RECORD_HEADER.size:
+                    break
+
+                flags, key_length, value_length, created_time, expire_time, crc = (
+                    SEGMENT_RECORD_HEADER.unpack_from(header))
+                size = SEGMENT_RECORD_HEADER.size + key_length + value_length
+                record = parse_segment_record(pread(fd, size, offset))
+                if record is None:
+                    # Incomplete record, ignore the rest of the segment
+                    break
+
+                previous = entries.pop(record[1], None)
+                if previous is not None:
+                    dead_bytes += previous[2]
+
+                if flags & SEGMENT_RECORD_DELETED:
+                    dead_bytes += size
+                else:
+                    entries[record[1]] = (number, offset, size)
+                offset += size
+
+            last_number = number
+            last_end = offset
+
+        entries = [(make_segment_key_hash(key), slot) for key, slot in entries.items()]
+        return entries, last_number, last_end, dead_bytes
+
+    def compact(self, force=False):
+        # One compaction at a time, for all processes
+        compact_lock_fd = os_open(self.compact_lock_path, O_RDWR | O_CREAT, 0o666)
+        try:
+            try:
+                flock(compact_lock_fd, LOCK_EX | LOCK_NB)
+            except (IOError, OSError):
+                return False
+            return self.compact_segments(force)
+        finally:
+            os_close(compact_lock_fd)
+
+    def compact_segments(self, force=False):
+        # Called with compact lock
+        for filename in get_dir_filenames(self.path):
+            if filename.startswith('compact-'):
+                remove_file_quietly(join_paths(self.path, filename))
+
+        self.lock_writes()
+        try:
+            self.check_index()
+            header = self.read_index_header()
+            magic, superseded, capacity, used, items, dead_bytes, old_number, end = header
+            if not dead_bytes:
+                return False
+
+            slots = [slot for slot_hash, slot in self.iter_live_slots()]
+            if not force:
+                live_bytes = sum(slot[2] for slot in slots)
+                if dead_bytes < ((dead_bytes + live_bytes) * self.compact_ratio):
+                    return False
+
+            # New writes go to the next segment, old segments will not change
+            header[6:] = (old_number + 1, 0)
+            self.write_index_header(header)
+        finally:
+            self.unlock_writes()
+
+        # Copy live records without the write lock
+        moved = {}
+        compact_number = 1
+        compact_end = 0
+        compact_fd = os_open(join_paths(self.path, SEGMENT_COMPACT_FILENAME % compact_number), O_RDWR | O_CREAT, 0o666)
+        try:
+            for number, offset, size in sorted(slots):
+                with self.thread_lock:
+                    fd = self.get_segment_fd(number)
+                    binary = fd is not None and pread(fd, size, offset) or None
+
+                record = binary and parse_segment_record(binary)
+                if record is None or self.record_expired(record):
+                    continue
+
+                if compact_end >= self.segment_size:
+                    os_close(compact_fd)
+                    compact_number += 1
+                    compact_end = 0
+                    compact_fd = os_open(
+                        join_paths(self.path, SEGMENT_COMPACT_FILENAME % compact_number),
+                        O_RDWR | O_CREAT, 0o666)
+
+                pwrite(compact_fd, binary, compact_end)
+                moved[(number, offset)] = (compact_number, compact_end, size)
+                compact_end += size
+        finally:
+            os_close(compact_fd)
+
+        self.lock_writes()
+        try:
+            self.check_index()
+            magic, superseded, capacity, used, items, new_dead_bytes, number, end = self.read_index_header()
+
+            # Compacted segments are placed after the last written segment
+            for i in range(1, compact_number + 1):
+                move_file(
+                    join_paths(self.path, SEGMENT_COMPACT_FILENAME % i),
+                    self.get_segment_path(number + i))
+
+            entries = []
+            for slot_hash, (slot_number, offset, size) in self.iter_live_slots():
+                if slot_number > old_number:
+                    # Written while compacting
+                    entries.append((slot_hash, (slot_number, offset, size)))
+                else:
+                    new_slot = moved.get((slot_number, offset))
+                    if new_slot is not None:
+                        entries.append((slot_hash, (number + new_slot[0], new_slot[1], new_slot[2])))
+
+            self.replace_index(
+                entries,
+                number + compact_number,
+                compact_end,
+                dead_bytes=max(new_dead_bytes - dead_bytes, 0))
+
+            # Nobody will read old segments again
+            self.close_segments_fds(until_number=old_number)
+            for segment_number in self.get_segment_numbers():
+                if segment_number <= old_number:
+                    remove_file_quietly(self.get_segment_path(segment_number))
+        finally:
+            self.unlock_writes()
+
+        return True
+
+    def compact_daemon(self, interval):
+        try:
+            self.compact()
+        except (IOError, OSError):
+            pass
+        return interval
+
+    def get_version(self, name, expire=MARKER):
+        with self.thread_lock:
+            self.check_index()
+            position, slot, record = self.find_slot(to_bytes(name), read_value=False)
+        if record is not None and not self.record_expired(record, expire):
+            return slot[:2]
+
+    def __contains__(self, name):
+        return self.get_version(name) is not None
+
+    def get_binary(self, name, expire=MARKER):
+        with self.thread_lock:
+            self.check_index()
+            position, slot, record = self.find_slot(to_bytes(name))
+
+        if record is None or self.record_expired(record, expire):
+            raise KeyError('Missing cache key "%s"' % name)
+        else:
+            return record[2]
+
+    def put_binary(self, name, binary, mode='put', expire=MARKER):
+        key = to_bytes(name)
+        binary = to_bytes(binary)
+
+        if expire is MARKER:
+            expire = self.expire
+        expire_time = expire and (NOW_TIME() + int(expire)) or 0
+
+        self.lock_writes()
+        try:
+            self.check_index()
+            if mode == 'append':
+                position, slot, record = self.find_slot(key)
+                if record is not None and not self.record_expired(record):
+                    binary = record[2] + binary
+
+            self.write_record(key, binary, expire_time=expire_time)
+        finally:
+            self.unlock_writes()
+
+    def __delitem__(self, name):
+        self.lock_writes()
+        try:
+            self.check_index()
+            self.write_record(to_bytes(name), b'', flags=SEGMENT_RECORD_DELETED)
+        finally:
+            self.unlock_writes()
+
+
+def make_segment_key_hash(key):
+    # Zero is reserved for empty index slots
+    return int(make_sha256(key)[:16], 16) or 1
+
+
+def build_segment_record(key, value, flags=0, created_time=0, expire_time=0):
+    body = key + value
+    return SEGMENT_RECORD_HEADER.pack(flags, len(key), len(value), created_time, expire_time, crc32(body)) + body
+
+
+def parse_segment_record(binary):
+    if len(binary) < SEGMENT_RECORD_HEADER.size:
+        return None
+
+    flags, key_length, value_length, created_time, expire_time, crc = SEGMENT_RECORD_HEADER.unpack_from(binary)
+    body = binary[SEGMENT_RECORD_HEADER.size:SEGMENT_RECORD_HEADER.size + key_length + value_length]
+    if len(body) != (key_length + value_length) or crc32(body) != crc:
+        return None
+    else:
+        return flags, body[:key_length], body[key_length:], created_time, expire_time
+
 
 class SaveMeMemcached(_SaveMe):
     def __init__(
             self,
             url,
             expire=None,
+            memory_size=None,
+            memory_share_values=False,
+            serializer=None,
+            compression=None,
+            compression_min_size=None,
+            compression_level=None,
             **settings):
 
         # Lock settings
@@ -288,6 +1272,8 @@ class SaveMeMemcached(_SaveMe):
         self.memcache = self.memcache_module.Client(url.split(';'), **settings)
         self.expire = maybe_integer(expire)
         self.lockme = LockMeMemcached(url, **lock_settings)
+        self.set_memory(memory_size, memory_share_values)
+        self.set_serializer(serializer, compression, compression_min_size, compression_level)
 
     def lock(self, *args, **kwargs):
         return self.lockme.lock(*args, **kwargs)
@@ -295,12 +1281,37 @@ class SaveMeMemcached(_SaveMe):
     def unlock(self, *args, **kwargs):
         return self.lockme.unlock(*args, **kwargs)
 
+    def lock_many(self, *args, **kwargs):
+        return self.lockme.lock_many(*args, **kwargs)
+
+    def unlock_many(self, *args, **kwargs):
+        return self.lockme.unlock_many(*args, **kwargs)
+
+    def locked(self, *args, **kwargs):
+        return self.lockme.locked(*args, **kwargs)
+
     def format_name(self, name):
         return to_bytes(make_sha256(name))
 
+    def format_version_name(self, name):
+        return to_bytes(make_sha256('version %s' % name))
+
     def __contains__(self, name):
         return self.memcache.get(self.format_name(name)) is not None
 
+    def get_version(self, name, expire=MARKER):
+        return self.memcache.get(self.format_version_name(name))
+
+    def get_versions(self, names, expire=MARKER):
+        return self._get_multi(names, self.format_version_name)
+
+    def _get_multi(self, names, format_name):
+        references = {format_name(name): name for name in names}
+        return {
+            references[key]: value
+            for key, value in self.memcache.get_multi(list(references.keys())).items()
+            if value is not None}
+
     def get_binary(self, name, expire=MARKER):
         binary = self.memcache.get(self.format_name(name))
         if binary is None:
@@ -308,6 +1319,9 @@ class SaveMeMemcached(_SaveMe):
         else:
             return binary
 
+    def get_binary_many(self, names, expire=MARKER):
+        return self._get_multi(names, self.format_name)
+
     def put_binary(self, name, binary, mode='wb', expire=MARKER):
         name_256 = self.format_name(name)
         if expire is MARKER:
@@ -316,71 +1330,330 @@ class SaveMeMemcached(_SaveMe):
         # Append to existing file
         if mode == 'append' and name in self:
             self.memcache.append(name_256, binary, time=expire or 0)
+            if self.memory is not None:
+                self.memcache.set(self.format_version_name(name), make_uuid_hash(), time=expire or 0)
+        elif self.memory is not None:
+            # Other processes compare this version with the one saved in memory
+            self.memcache.set_multi(
+                {name_256: binary, self.format_version_name(name): make_uuid_hash()},
+                time=expire or 0)
         else:
             self.memcache.set(name_256, binary, time=expire or 0)
 
+    def put_binary_many(self, binaries, expire=MARKER):
+        if expire is MARKER:
+            expire = self.expire
+
+        mapping = {}
+        for name, binary in binaries.items():
+            mapping[self.format_name(name)] = binary
+            if self.memory is not None:
+                mapping[self.format_version_name(name)] = make_uuid_hash()
+
+        self.memcache.set_multi(mapping, time=expire or 0)
+
     def __delitem__(self, name):
-        self.memcache.delete(self.format_name(name))
+        if self.memory is not None:
+            self.memcache.delete_multi([self.format_name(name), self.format_version_name(name)])
+        else:
+            self.memcache.delete(self.format_name(name))
+
+    def delete_binary_many(self, names):
+        keys = []
+        for name in names:
+            keys.append(self.format_name(name))
+            if self.memory is not None:
+                keys.append(self.format_version_name(name))
+        self.memcache.delete_multi(keys)
 
 
 class api_cache_decorator(object):
-    def __init__(self, expire_seconds=900):
+    def __init__(
+            self,
+            expire_seconds=900,
+            stale_seconds=0,
+            early_refresh=0,
+            lock_timeout=30,
+            args_names=None,
+            ignore_args_names=None):
+
         self.cache_name = None
+        self.lock_name = None
+        self.references_name = None
+        self.references_trim_size = 1000
         self.wrapper = None
+        self.signature = None
         self.expire_seconds = expire_seconds
+        self.stale_seconds = stale_seconds or 0
+        self.early_refresh = early_refresh or 0
+        self.lock_timeout = lock_timeout
+        self.args_names = maybe_set(args_names)
+        self.ignore_args_names = maybe_set(ignore_args_names)
 
         self.father = None
         self.children = []
 
     def __call__(self, wrapped):
         @wraps(wrapped)
-        def wrapper(cls, expire_cache=False, no_cache=False):
+        def wrapper(cls, *args, expire_cache=False, no_cache=False, **kwargs):
             if expire_cache:
                 return self.expire(cls)
 
-            elif not no_cache:
-                cached = cls.config.cache.get(self.cache_name, default=MARKER, expire=self.expire_seconds)
-                if cached is not MARKER:
-                    return cached
+            key = self.get_arguments_key(cls, args, kwargs)
+            if no_cache:
+                return self.compute(cls, wrapped, key, args, kwargs)
 
-            cached = wrapped(cls)
-            cls.config.cache.put(self.cache_name, cached, expire=self.expire_seconds)
-            return cached
+            entry = self.get_entry(cls.config.cache, key)
+            if entry is not None:
+                created_time, compute_seconds, value = entry
+                if self.is_fresh(created_time):
+                    if self.early_refresh and self.refresh_early(created_time, compute_seconds):
+                        self.refresh_on_background(cls, wrapped, key, args, kwargs, created_time)
+                    return value
+
+                elif self.stale_seconds:
+                    # Give stale value while someone refreshes it
+                    self.refresh_on_background(cls, wrapped, key, args, kwargs, created_time)
+                    return value
+
+            return self.refresh(cls, wrapped, key, args, kwargs)
 
         self.cache_name = 'ines.api_cache_decorator %s %s' % (wrapped.__module__, wrapped.__qualname__)
+        self.lock_name = 'ines.api_cache_decorator lock %s %s' % (wrapped.__module__, wrapped.__qualname__)
+        self.references_name = 'ines.api_cache_decorator references %s %s' % (
+            wrapped.__module__, wrapped.__qualname__)
+        self.signature = signature(wrapped)
         self.wrapper = wrapper
         return wrapper
 
+    def get_arguments_key(self, cls, args, kwargs):
+        if not args and not kwargs:
+            return None
+
+        arguments = self.signature.bind(cls, *args, **kwargs)
+        arguments.apply_defaults()
+
+        values = []
+        for i, (name, value) in enumerate(arguments.arguments.items()):
+            if (i  # Ignore api session
+                    and (not self.args_names or name in self.args_names)
+                    and name not in self.ignore_args_names):
+                values.append((name, normalize_cache_argument(value)))
+
+        if values:
+            return make_sha256(repr(values))
+
+    def get_cache_name(self, key):
+        return key and '%s %s' % (self.cache_name, key) or self.cache_name
+
+    def get_lock_name(self, key):
+        return key and '%s %s' % (self.lock_name, key) or self.lock_name
+
+    @property
+    def cache_expire_seconds(self):
+        if self.expire_seconds:
+            return self.expire_seconds + self.stale_seconds
+
+    def is_fresh(self, created_time):
+        return not self.expire_seconds or (created_time + self.expire_seconds) > time()
+
+    def refresh_early(self, created_time, compute_seconds):
+        # Probabilistic early expiration, slow methods start refreshing sooner
+        if not self.expire_seconds:
+            return False
+        delta = compute_seconds * self.early_refresh * -log(1.0 - random())
+        return (time() + delta) >= (created_time + self.expire_seconds)
+
+    def get_entry(self, cache, key=None):
+        cached = cache.get(self.get_cache_name(key), default=MARKER, expire=self.cache_expire_seconds)
+        if (isinstance(cached, (list, tuple))
+                and len(cached) == 4
+                and cached[0] == API_CACHE_DECORATOR_ENTRY):
+            return cached[1:]
+
+    def compute(self, cls, wrapped, key=None, args=(), kwargs=None, new_entry=True):
+        started_time = time()
+        value = wrapped(cls, *args, **(kwargs or {}))
+        finished_time = time()
+
+        cache = cls.config.cache
+        if key and new_entry:
+            # Used to expire all arguments variations
+            self.put_reference(cache, key)
+
+        cache.put(
+            self.get_cache_name(key),
+            (API_CACHE_DECORATOR_ENTRY, finished_time, finished_time - started_time, value),
+            expire=self.cache_expire_seconds)
+
+        return value
+
+    def get_references(self, cache):
+        # Saved as "key time" lines
+        references = {}
+        for line in cache.get_values(self.references_name, expire=None):
+            values = to_string(line).split()
+            if values:
+                references[values[0]] = len(values) > 1 and float(values[1]) or 0
+        return references
+
+    def put_reference(self, cache, key):
+        cache.lock(self.references_name, timeout=self.lock_timeout)
+        try:
+            references = self.get_references(cache)
+            if key in references:
+                return None
+
+            references[key] = time()
+            if len(references) < self.references_trim_size:
+                cache.append_value(self.references_name, '%s %s' % (key, references[key]), expire=None)
+            else:
+                # Remove references without values, added before our lock timeout
+                valid_time = time() - self.lock_timeout
+                names = dict(
+                    (self.get_cache_name(k), k)
+                    for k, t in references.items()
+                    if t < valid_time and k != key)
+                for name in self.get_missing_names(cache, names):
+                    references.pop(names[name])
+
+                self.references_trim_size = max(1000, len(references) * 2)
+                cache.replace_values(
+                    self.references_name,
+                    [to_bytes('%s %s' % (k, t)) for k, t in references.items()],
+                    expire=None)
+        finally:
+            cache.unlock(self.references_name)
+
+    def get_missing_names(self, cache, names, chunk_size=100):
+        # Values are read in chunks, version keys are not saved by every backend
+        names = list(names)
+        missing_names = []
+        for i in range(0, len(names), chunk_size):
+            chunk = names[i:i + chunk_size]
+            binaries = cache.get_binary_many(chunk, expire=self.cache_expire_seconds)
+            missing_names.extend(name for name in chunk if name not in binaries)
+        return missing_names
+
+    def refresh(self, cls, wrapped, key=None, args=(), kwargs=None, seen_created_time=None, background=False):
+        cache = cls.config.cache
+        lock_name = self.get_lock_name(key)
+        try:
+            cache.lock(lock_name, timeout=self.lock_timeout)
+        except LockTimeout:
+            if background:
+                return None
+            # Waited too long, compute it anyway
+            return self.compute(cls, wrapped, key, args, kwargs)
+
+        try:
+            # Someone may have refreshed it while we were waiting
+            entry = self.get_entry(cache, key)
+            if entry is not None:
+                if seen_created_time is None:
+                    if self.is_fresh(entry[0]):
+                        return entry[2]
+                elif entry[0] > seen_created_time:
+                    return entry[2]
+
+            return self.compute(cls, wrapped, key, args, kwargs, new_entry=entry is None)
+        finally:
+            cache.unlock(lock_name)
+
+    def refresh_on_background(self, cls, wrapped, key, args, kwargs, seen_created_time):
+        thread_name = 'api_cache_decorator %s' % self.get_cache_name(key)
+        if thread_is_running(thread_name):
+            return None
+
+        # Request session can be closed before we finish
+        api_session = cls.api_session_manager(make_request(cls.config, cls.request.environ.copy()))
+
+        def refresh_method():
+            try:
+                self.refresh(api_session, wrapped, key, args, kwargs, seen_created_time, background=True)
+            except Exception as error:
+                api_session.logging.log_critical('api_cache_decorator_error', str(error))
+
+        try:
+            start_system_thread(thread_name, refresh_method, sleep_method=False)
+        except KeyError:
+            # Already started by other thread
+            pass
+
     def child(self, expire_seconds=MARKER):
         if expire_seconds is MARKER:
             expire_seconds = self.expire_seconds
 
-        new = api_cache_decorator(expire_seconds=expire_seconds)
+        new = api_cache_decorator(
+            expire_seconds=expire_seconds,
+            stale_seconds=self.stale_seconds,
+            early_refresh=self.early_refresh,
+            lock_timeout=self.lock_timeout)
         new.father = self
         self.children.append(new)
         return new
 
+    def get_expire_decorators(self, expire_children=False, ignore_father=False):
+        decorators = [self]
+        if expire_children:
+            decorators.extend(child for child in self.children if child.wrapper and child.cache_name)
+
+        if not ignore_father and self.father and self.father.wrapper and self.father.cache_name:
+            decorators.extend(self.father.get_expire_decorators())
+
+        return decorators
+
+    def get_expire_names(self, expire_children=False, ignore_father=False):
+        return [
+            decorator.cache_name
+            for decorator in self.get_expire_decorators(expire_children, ignore_father)]
+
     def expire(self, api_session, expire_children=False, ignore_father=False):
         if self.wrapper and self.cache_name:
-            if expire_children and self.children:
-                for child in self.children:
-                    child.expire(api_session, ignore_father=True)
+            decorators = self.get_expire_decorators(expire_children, ignore_father)
 
-            clear_paths = []
+            # Applications can share the same cache
+            caches = {}
             for app_session in api_session.applications.asdict().values():
-                cache_path = app_session.cache.path
-                if cache_path not in clear_paths:
-                    clear_paths.append(cache_path)
-                    app_session.cache.remove(self.cache_name)
+                cache = app_session.cache
+                caches.setdefault(getattr(cache, 'path', None) or id(cache), cache)
 
-            if not ignore_father and self.father:
-                self.father.expire(api_session)
+            for cache in caches.values():
+                names = set()
+                for decorator in decorators:
+                    names.add(decorator.cache_name)
+                    names.add(decorator.references_name)
+                    names.update(
+                        decorator.get_cache_name(key)
+                        for key in decorator.get_references(cache))
+
+                cache.delete_many(names)
 
             return True
 
         return False
 
 
+def normalize_cache_argument(value):
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (repr(normalize_cache_argument(key)), normalize_cache_argument(item))
+            for key, item in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(normalize_cache_argument(item) for item in value)
+    elif isinstance(value, (set, frozenset)):
+        return tuple(sorted(repr(normalize_cache_argument(item)) for item in value))
+    elif isinstance(value, bytes):
+        return to_string(value)
+    elif value is None or isinstance(value, API_CACHE_ARGUMENTS_TYPES):
+        return value
+    else:
+        # Default repr has the memory address, key would change on every call
+        raise TypeError(
+            'Invalid api_cache_decorator argument %s, use args_names or ignore_args_names'
+            % type(value).__name__)
+
+
 def clear_lock_key(key):
     return clean_string(key).lower().strip().replace(' ', '')
 
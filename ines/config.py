@@ -37,7 +37,7 @@ from ines.authentication import ApplicationHeaderAuthenticationPolicy
 from ines.authorization import Everyone
 from ines.authorization import INES_POLICY
 from ines.authorization import TokenAuthorizationPolicy
-from ines.cache import SaveMe, SaveMeMemcached
+from ines.cache import SaveMe, SaveMeMemcached, SaveMeSegments
 from ines.convert import maybe_list
 from ines.exceptions import Error
 from ines.exceptions import HTTPBrowserUpgrade
@@ -131,6 +131,10 @@ class Configurator(PyramidConfigurator):
         cache_type = cache_settings.pop('type', None)
         if cache_type == 'memcached':
             self.cache = SaveMeMemcached(**cache_settings)
+        elif cache_type == 'segment':
+            if 'path' not in cache_settings:
+                cache_settings['path'] = DEFAULT_CACHE_DIRPATH
+            self.cache = SaveMeSegments(**cache_settings)
         else:
             if 'path' not in cache_settings:
                 cache_settings['path'] = DEFAULT_CACHE_DIRPATH
@@ -1,28 +1,77 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
+from contextlib import contextmanager
 import errno
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
 from functools import lru_cache
-from os import getpgid, walk as walk_on_path
-from os.path import isfile, join as join_paths
-from time import sleep
+from os import close as os_close, fstat, getpgid, O_CREAT, O_RDWR, open as os_open, rmdir, scandir
+from os.path import basename, dirname, isfile, join as join_paths
+from threading import Lock
+from time import sleep, time
 
 from ines import DEFAULT_RETRY_ERRNO, DOMAIN_NAME, lazy_import_module, MARKER, NEW_LINE, NOW_TIME, PROCESS_ID
 from ines.convert import make_sha256, maybe_integer, maybe_set, to_bytes, to_string
 from ines.exceptions import LockTimeout
-from ines.system import start_system_thread, thread_is_running
+from ines.system import register_after_fork, start_system_thread, thread_is_running
 from ines.utils import (
-    file_modified_time, get_dir_filenames, get_file_binary, make_dir, make_uuid_hash, put_binary_on_file, remove_file,
-    remove_file_quietly)
+    file_modified_time, file_stat, get_dir_filenames, get_file_binary, make_dir, make_uuid_hash, put_binary_on_file,
+    remove_file, remove_file_quietly)
 
 
-class LockMe(object):
+class _LockMe(object):
+    timeout = None
+
+    def prepare_lock_many(self, names):
+        pass
+
+    def lock_many(self, names, timeout=MARKER, delete_lock_on_timeout=MARKER, shared=False):
+        # Always the same order, so lockers of the same names never deadlock
+        names = sorted(set(names))
+        if not names:
+            return None
+
+        if timeout is MARKER:
+            timeout = self.timeout
+        expire_time = timeout and (NOW_TIME() + int(timeout)) or None
+
+        self.prepare_lock_many(names)
+
+        locked_names = []
+        try:
+            for name in names:
+                if expire_time:
+                    timeout = max(expire_time - NOW_TIME(), 1)
+                self.lock(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout, shared=shared)
+                locked_names.append(name)
+        except:
+            self.unlock_many(locked_names, shared=shared)
+            raise
+
+    def unlock_many(self, names, shared=False):
+        for name in set(names):
+            self.unlock(name, shared=shared)
+
+    @contextmanager
+    def locked(self, name, shared=False, **kwargs):
+        self.lock(name, shared=shared, **kwargs)
+        try:
+            yield
+        finally:
+            self.unlock(name, shared=shared)
+
+
+class LockMe(_LockMe):
     def __init__(
             self,
             path,
             timeout=30,
             delete_lock_on_timeout=False,
             retry_errno=None,
-            retries=3):
+            retries=3,
+            clean_interval=60,
+            clean_max_seconds=1,
+            clean_max_files=1000):
 
         self.path = make_dir(path)
         self.timeout = int(timeout)
@@ -30,9 +79,25 @@ class LockMe(object):
         self.retries = maybe_integer(retries) or 3
         self.retry_errno = maybe_set(retry_errno)
         self.retry_errno.update(DEFAULT_RETRY_ERRNO)
+        self.shared_codes = defaultdict(list)
+        self.thread_lock = Lock()
+
+        # Junk locks are cleaned a few files at a time, from where the last run stopped
+        self.clean_interval = maybe_integer(clean_interval) or 60
+        self.clean_max_seconds = float(clean_max_seconds or 0)
+        self.clean_max_files = maybe_integer(clean_max_files) or 0
+        self.clean_iterator = None
+        self.clean_lock = Lock()
+        self.clean_report = {'runs': 0, 'cycles': 0, 'checked': 0, 'removed': 0}
 
         # Clean locks!
         self.clean_junk_locks_as_daemon()
+        register_after_fork(self.restart_clean_junk_locks)
+
+    def restart_clean_junk_locks(self):
+        # Folder reading position is shared with the parent process
+        self.clean_iterator = None
+        self.clean_junk_locks_as_daemon()
 
     @lru_cache(1000)
     def get_file_path(self, name):
@@ -43,10 +108,75 @@ class LockMe(object):
         name_256 = make_sha256(name)
         return join_paths(self.path, name_256[0])
 
+    def prepare_lock_many(self, names):
+        for folder_path in set(self.get_folder_path(name) for name in names):
+            make_dir(folder_path)
+
     def __contains__(self, name):
         return isfile(self.get_file_path(name))
 
-    def lock(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER):
+    def get_readers_path(self, name):
+        # Readers of each key have their own folder, writers only list this one
+        return self.get_file_path(name) + '-readers'
+
+    def get_shared_paths(self, name):
+        readers_path = self.get_readers_path(name)
+        return [join_paths(readers_path, filename) for filename in get_dir_filenames(readers_path)]
+
+    def lock(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER, shared=False):
+        if timeout is MARKER:
+            timeout = self.timeout
+        expire_time = timeout and (NOW_TIME() + int(timeout)) or None
+
+        self.lock_wait_list(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+        if shared:
+            # Register as reader and let others readers in
+            lock_code = make_uuid_hash()
+            put_binary_on_file(
+                join_paths(self.get_readers_path(name), lock_code),
+                '%s %s %s' % (DOMAIN_NAME, PROCESS_ID, lock_code),
+                retries=self.retries,
+                retry_errno=self.retry_errno)
+
+            with self.thread_lock:
+                self.shared_codes[name].append(lock_code)
+            self.unlock(name)
+
+        else:
+            try:
+                self.wait_for_shared_locks(name, expire_time, timeout, delete_lock_on_timeout)
+            except:
+                self.unlock(name)
+                raise
+
+    def wait_for_shared_locks(self, name, expire_time, timeout, delete_lock_on_timeout=MARKER):
+        while True:
+            shared_paths = []
+            for shared_path in self.get_shared_paths(name):
+                binary = get_file_binary(shared_path, mode='r')
+                if binary and is_dead_lock_code(binary):
+                    remove_file_quietly(shared_path, retries=self.retries, retry_errno=self.retry_errno)
+                elif binary is not None:
+                    shared_paths.append(shared_path)
+
+            if not shared_paths:
+                return None
+
+            elif expire_time and NOW_TIME() > expire_time:
+                if delete_lock_on_timeout is MARKER:
+                    delete_lock_on_timeout = self.delete_lock_on_timeout
+                if delete_lock_on_timeout:
+                    for shared_path in shared_paths:
+                        remove_file_quietly(shared_path, retries=self.retries, retry_errno=self.retry_errno)
+                    return None
+
+                message = 'Timeout (%ss) on lock "%s" waiting for shared locks. Delete (%s) to unlock' % (
+                    timeout, name, self.get_readers_path(name))
+                raise LockTimeout(message, shared_paths[0])
+
+            sleep(0.1)
+
+    def lock_wait_list(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER):
         path = self.get_file_path(name)
         lock_code = make_uuid_hash()
         lock_name = '%s %s %s' % (DOMAIN_NAME, PROCESS_ID, lock_code)
@@ -54,11 +184,8 @@ class LockMe(object):
 
         position = None
         while position is None:
-            # Enter on wait list
-            put_binary_on_file(path, lock_name_to_file, mode='a', retries=self.retries, retry_errno=self.retry_errno)
-
-            # Find my wait position
-            binary = get_file_binary(path, mode='r', retries=self.retries, retry_errno=self.retry_errno)
+            # Enter on wait list and find my wait position
+            binary = self.append_to_wait_list(path, lock_name_to_file)
             if binary:
                 for i, code in enumerate(binary.splitlines()):
                     if code.split()[-1] == lock_code:
@@ -100,7 +227,7 @@ class LockMe(object):
                 if delete_lock_on_timeout:
                     self.unlock(name)
                     # Sorry, you need to do everything again
-                    return self.lock(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+                    return self.lock_wait_list(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
                 else:
                     # Clean locks!
                     self.clean_junk_locks_as_daemon()
@@ -110,110 +237,424 @@ class LockMe(object):
 
         remove_file_quietly(position_path, retries=self.retries, retry_errno=self.retry_errno)
 
-    def unlock(self, name):
-        name_256 = make_sha256(name)
-        pattern_name = name_256 + '.'
-        folder_path = join_paths(self.path, name_256[0])
+    def append_to_wait_list(self, path, lock_name_to_file, retries=None):
+        # Same file open to write and read
+        if retries is None:
+            retries = self.retries
+        try:
+            with open(path, 'a+') as f:
+                f.write(lock_name_to_file)
+                f.seek(0)
+                binary = f.read()
+
+                # Unlocked and deleted before we wrote, enter again
+                stat = file_stat(path)
+                if stat is not None and stat.st_ino == fstat(f.fileno()).st_ino:
+                    return binary
+        except IOError as error:
+            if error.errno is errno.ENOENT:
+                make_dir(dirname(path))
+            elif error.errno not in self.retry_errno:
+                raise
+
+            retries -= 1
+            if not retries:
+                raise
+            return self.append_to_wait_list(path, lock_name_to_file, retries)
+
+    def unlock_many(self, names, shared=False):
+        if shared:
+            return super(LockMe, self).unlock_many(names, shared=shared)
+
+        # List each folder only once
+        folders = defaultdict(dict)
+        for name in set(names):
+            path = self.get_file_path(name)
+            folders[dirname(path)][basename(path)] = path
+
+        for folder_path, paths in folders.items():
+            positions = defaultdict(list)
+            for filename in get_dir_filenames(folder_path):
+                if '.' in filename:
+                    name_256, position = filename.split('.', 1)
+                    if name_256 in paths and position.isnumeric():
+                        positions[name_256].append((int(position), filename))
 
-        # Lookup for locked positions
-        files = []
-        for filename in get_dir_filenames(folder_path):
-            if filename.startswith(pattern_name):
-                position = int(filename.split('.', 1)[1])
-                files.append((position, filename))
-        if files:
-            files.sort()
+            for name_256, path in paths.items():
+                self.release_wait_list(path, positions.get(name_256))
 
-            for position, filename in files:
-                file_path = join_paths(folder_path, filename)
+    def release_wait_list(self, path, positions):
+        if positions:
+            folder_path = dirname(path)
+            for position, filename in sorted(positions):
                 if remove_file(
-                        file_path,
+                        join_paths(folder_path, filename),
                         retries=self.retries,
                         retry_errno=self.retry_errno):
                     return True
 
         # If no position found, delete base lock
-        return remove_file_quietly(self.get_file_path(name), retries=self.retries, retry_errno=self.retry_errno)
+        return remove_file_quietly(path, retries=self.retries, retry_errno=self.retry_errno)
 
-    def clean_junk_locks(self):
-        for path, dirnames, filenames in walk_on_path(self.path):
-            filenames = filenames or []
-            for dirname in dirnames:
-                folder_path = join_paths(path, dirname)
-                for filename in get_dir_filenames(folder_path):
-                    if not filename.startswith('.'):
-                        filenames.append(join_paths(dirname, filename))
-
-            for filename in filenames:
-                filename = to_string(filename)
-                if filename.startswith('.'):
-                    continue
+    def unlock(self, name, shared=False):
+        if shared:
+            with self.thread_lock:
+                lock_codes = self.shared_codes.get(name)
+                if not lock_codes:
+                    return False
 
-                file_path = join_paths(path, filename)
-                if '.' in filename:
-                    # Delete inactive positions locks
-                    binary = get_file_binary(file_path, mode='r')
-                    if binary:
-                        info = binary.split()
-                        if len(info) >= 2 and info[0] == DOMAIN_NAME and maybe_integer(info[1]):
-                            try:
-                                getpgid(int(info[1]))
-                            except OSError as error:
-                                if error.errno is errno.ESRCH:
-                                    remove_file_quietly(
-                                        file_path,
-                                        retries=self.retries,
-                                        retry_errno=self.retry_errno)
+                lock_code = lock_codes.pop(0)
+                if not lock_codes:
+                    self.shared_codes.pop(name)
 
-                else:
-                    # Clean locks wait list
-                    # Get last modified time, to check if file as been updated in the process
-                    modified_time = file_modified_time(file_path)
-                    if modified_time:
-                        binary = get_file_binary(file_path, mode='r')
-                        if binary:
-                            # Find alive locks
-                            keep_codes = binary.splitlines()
-                            for i, line in enumerate(keep_codes):
-                                info = line.split()
-                                if len(info) >= 2 and info[0] == DOMAIN_NAME and maybe_integer(info[1]):
-                                    try:
-                                        getpgid(int(info[1]))
-                                    except OSError as error:
-                                        if error.errno is errno.ESRCH:
-                                            # Add empty line to keep position number
-                                            keep_codes[i] = ''
-
-                            # Check if file as been updated in the process
-                            last_modified_time = file_modified_time(file_path)
-                            if last_modified_time and modified_time == last_modified_time:
-                                if not any(keep_codes):
-                                    remove_file_quietly(file_path)
-                                else:
-                                    with open(file_path, 'w') as f:
-                                        f.write(NEW_LINE.join(keep_codes))
+            return remove_file_quietly(
+                join_paths(self.get_readers_path(name), lock_code),
+                retries=self.retries,
+                retry_errno=self.retry_errno)
+
+        path = self.get_file_path(name)
+        pattern_name = basename(path) + '.'
+
+        # Lookup for locked positions
+        positions = []
+        for filename in get_dir_filenames(dirname(path)):
+            if filename.startswith(pattern_name):
+                positions.append((int(filename.split('.', 1)[1]), filename))
+        return self.release_wait_list(path, positions)
+
+    def clean_junk_locks(self, max_seconds=MARKER, max_files=MARKER):
+        if max_seconds is MARKER:
+            max_seconds = self.clean_max_seconds
+        if max_files is MARKER:
+            max_files = self.clean_max_files
+
+        started_time = time()
+        report = {'checked': 0, 'removed': 0, 'finished': False}
+
+        with self.clean_lock:
+            if self.clean_iterator is None:
+                self.clean_iterator = self.iter_lock_files()
+
+            while not ((max_files and report['checked'] >= max_files)
+                       or (max_seconds and (time() - started_time) >= max_seconds)):
+                try:
+                    file_path, filename = next(self.clean_iterator)
+                except StopIteration:
+                    # Every folder checked, start again on next run
+                    self.clean_iterator = None
+                    report['finished'] = True
+                    break
+
+                report['removed'] += self.clean_junk_lock_file(file_path, filename)
+                report['checked'] += 1
+
+        self.clean_report['runs'] += 1
+        self.clean_report['checked'] += report['checked']
+        self.clean_report['removed'] += report['removed']
+        if report['finished']:
+            self.clean_report['cycles'] += 1
+
+        return report
+
+    def iter_lock_files(self):
+        # Folders are read while iterating, next run continues from the same entry
+        for folder_name in sorted(get_dir_filenames(self.path)):
+            if folder_name.startswith('.'):
+                continue
+
+            try:
+                entries = scandir(join_paths(self.path, folder_name))
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    if not entry.name.startswith('.'):
+                        yield entry.path, entry.name
+
+    def clean_junk_lock_file(self, file_path, filename):
+        filename = to_string(filename)
+        if filename.endswith('-readers'):
+            # Delete readers of dead processes
+            removed = 0
+            for reader_filename in get_dir_filenames(file_path):
+                reader_path = join_paths(file_path, reader_filename)
+                binary = get_file_binary(reader_path, mode='r')
+                if binary and is_dead_lock_code(binary):
+                    remove_file_quietly(reader_path, retries=self.retries, retry_errno=self.retry_errno)
+                    removed += 1
+
+            try:
+                rmdir(file_path)
+            except OSError:
+                # Still have readers
+                pass
+            return removed
+
+        elif '.' in filename:
+            # Delete inactive positions locks
+            binary = get_file_binary(file_path, mode='r')
+            if binary and is_dead_lock_code(binary):
+                remove_file_quietly(file_path, retries=self.retries, retry_errno=self.retry_errno)
+                return 1
+
+        else:
+            # Clean locks wait list
+            # Get last modified time, to check if file as been updated in the process
+            modified_time = file_modified_time(file_path)
+            if modified_time:
+                binary = get_file_binary(file_path, mode='r')
+                if binary:
+                    # Find alive locks
+                    removed = 0
+                    keep_codes = binary.splitlines()
+                    for i, line in enumerate(keep_codes):
+                        if line and is_dead_lock_code(line):
+                            # Add empty line to keep position number
+                            keep_codes[i] = ''
+                            removed += 1
+
+                    # Check if file as been updated in the process
+                    if removed:
+                        last_modified_time = file_modified_time(file_path)
+                        if last_modified_time and modified_time == last_modified_time:
+                            if not any(keep_codes):
+                                remove_file_quietly(file_path)
+                            else:
+                                with open(file_path, 'w') as f:
+                                    f.write(NEW_LINE.join(keep_codes))
+                            return removed
+
+        return 0
+
+    def clean_junk_locks_step(self):
+        report = self.clean_junk_locks()
+        if report['finished'] or not report['checked']:
+            return self.clean_interval
+        else:
+            # Budget ended in the middle of a cycle, continue soon
+            return 1
 
     def clean_junk_locks_as_daemon(self):
-        if not thread_is_running('clean_junk_locks'):
+        thread_name = 'clean_junk_locks %s' % self.path
+        if not thread_is_running(thread_name):
             # Shhh.. Do it quietly!
-            start_system_thread('clean_junk_locks', self.clean_junk_locks, sleep_method=False)
+            try:
+                start_system_thread(thread_name, self.clean_junk_locks_step)
+            except KeyError:
+                pass
+
+
+class LockMeFlock(_LockMe):
+    def __init__(
+            self,
+            path,
+            timeout=30,
+            delete_lock_on_timeout=False,
+            retry_errno=None,
+            retries=3):
+
+        self.path = make_dir(path)
+        self.timeout = int(timeout)
+        self.delete_lock_on_timeout = delete_lock_on_timeout
+        self.retries = maybe_integer(retries) or 3
+        self.retry_errno = maybe_set(retry_errno)
+        self.retry_errno.update(DEFAULT_RETRY_ERRNO)
+
+        # Files descriptors holding kernel locks, released on close or when the process dies
+        self.locked_fds = defaultdict(list)
+        self.thread_lock = Lock()
+        register_after_fork(self.close_inherited_fds)
+
+    def close_inherited_fds(self):
+        # Locks belong to the parent process, closing our copy doesn't release them
+        with self.thread_lock:
+            for fds in self.locked_fds.values():
+                for fd in fds:
+                    os_close(fd)
+            self.locked_fds.clear()
+
+    @lru_cache(1000)
+    def get_file_path(self, name):
+        name_256 = make_sha256(name)
+        return join_paths(self.path, name_256[0], name_256)
 
+    def prepare_lock_many(self, names):
+        for folder_path in set(dirname(self.get_file_path(name)) for name in names):
+            make_dir(folder_path)
 
-class LockMeMemcached(object):
+    def open_lock_file(self, path):
+        try:
+            return os_open(path, O_RDWR | O_CREAT, 0o666)
+        except OSError as error:
+            if error.errno is errno.ENOENT:
+                make_dir(dirname(path))
+                return os_open(path, O_RDWR | O_CREAT, 0o666)
+            raise
+
+    def __contains__(self, name):
+        path = self.get_file_path(name)
+        try:
+            fd = os_open(path, O_RDWR)
+        except OSError as error:
+            if error.errno is errno.ENOENT:
+                return False
+            raise
+
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        else:
+            self.remove_lock_file(fd, path)
+            return False
+        finally:
+            os_close(fd)
+
+    def lock(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER, shared=False):
+        path = self.get_file_path(name)
+        operation = shared and LOCK_SH or LOCK_EX
+
+        if timeout is MARKER:
+            timeout = self.timeout
+        expire_time = timeout and (time() + float(timeout)) or None
+
+        while True:
+            fd = self.open_lock_file(path)
+            try:
+                acquired = wait_for_flock(fd, operation, expire_time and max(expire_time - time(), 0.001))
+            except:
+                os_close(fd)
+                raise
+
+            if not acquired:
+                os_close(fd)
+                if delete_lock_on_timeout is MARKER:
+                    delete_lock_on_timeout = self.delete_lock_on_timeout
+                if delete_lock_on_timeout:
+                    # New lockers will use a new file
+                    remove_file_quietly(path, retries=self.retries, retry_errno=self.retry_errno)
+                    return self.lock(
+                        name,
+                        timeout=timeout,
+                        delete_lock_on_timeout=delete_lock_on_timeout,
+                        shared=shared)
+
+                message = 'Timeout (%ss) on lock "%s". Delete (%s) to unlock' % (timeout, name, path)
+                raise LockTimeout(message, path)
+
+            if is_same_file(fd, path):
+                break
+
+            # Last holder removed this file, lock the new one
+            os_close(fd)
+
+        with self.thread_lock:
+            self.locked_fds[(path, bool(shared))].append(fd)
+
+    def unlock(self, name, shared=False):
+        path = self.get_file_path(name)
+        key = (path, bool(shared))
+        with self.thread_lock:
+            fds = self.locked_fds.get(key)
+            if not fds:
+                return False
+
+            fd = fds.pop(0)
+            if not fds:
+                self.locked_fds.pop(key)
+
+        try:
+            if shared:
+                # Only the last reader removes the file
+                try:
+                    flock(fd, LOCK_EX | LOCK_NB)
+                except OSError as error:
+                    if error.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    return True
+
+            self.remove_lock_file(fd, path)
+        finally:
+            os_close(fd)
+        return True
+
+    def remove_lock_file(self, fd, path):
+        # Removed while locked, waiters of this file see it was replaced and open it again
+        if is_same_file(fd, path):
+            remove_file_quietly(path, retries=self.retries, retry_errno=self.retry_errno)
+        flock(fd, LOCK_UN)
+
+    def clean_junk_locks(self):
+        # Kernel releases locks of dead processes
+        pass
+
+    def clean_junk_locks_as_daemon(self):
+        pass
+
+
+def is_same_file(fd, path):
+    stat = file_stat(path)
+    if stat is None:
+        return False
+    fd_stat = fstat(fd)
+    return stat.st_ino == fd_stat.st_ino and stat.st_dev == fd_stat.st_dev
+
+
+def wait_for_flock(fd, operation, timeout=None):
+    if not timeout:
+        # Kernel wakes us when the lock is released
+        flock(fd, operation)
+        return True
+
+    # flock has no timeout, try again with a short sleep
+    expire_time = time() + float(timeout)
+    sleep_seconds = 0.0005
+    while True:
+        try:
+            flock(fd, operation | LOCK_NB)
+        except OSError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            return True
+
+        wait_seconds = expire_time - time()
+        if wait_seconds <= 0:
+            return False
+
+        sleep(min(sleep_seconds, wait_seconds))
+        sleep_seconds = min(sleep_seconds * 2, 0.005)
+
+
+class LockMeMemcached(_LockMe):
     def __init__(
             self,
             url,
             timeout=30,
             delete_lock_on_timeout=False,
+            shared_expire=300,
             **settings):
 
         self.memcache = lazy_import_module('memcache').Client(url.split(';'), **settings)
         self.timeout = int(timeout)
         self.delete_lock_on_timeout = delete_lock_on_timeout
+        # Each reader has its own key, forgotten after this seconds if never unlocked
+        self.shared_expire = maybe_integer(shared_expire) or 300
+        self.shared_codes = defaultdict(list)
+        self.thread_lock = Lock()
 
     def format_name(self, name):
         return to_bytes(make_sha256('locks %s' % name))
 
+    def format_shared_name(self, name):
+        return to_bytes(make_sha256('locks shared %s' % name))
+
+    def format_reader_name(self, name, code):
+        return to_bytes(make_sha256('locks reader %s %s' % (name, code)))
+
     def format_position_name(self, name_256, position):
         name = '%s.%s' % (name_256, position)
         return to_bytes(make_sha256(name))
@@ -224,7 +665,71 @@ class LockMeMemcached(object):
     def __contains__(self, name):
         return self._contains(self.format_name(name))
 
-    def lock(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER):
+    def lock(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER, shared=False):
+        if timeout is MARKER:
+            timeout = self.timeout
+        expire_time = timeout and (NOW_TIME() + int(timeout)) or None
+
+        self.lock_wait_list(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+        shared_name = self.format_shared_name(name)
+
+        if shared:
+            # Register as reader and let others readers in
+            code = make_uuid_hash()
+            self.memcache.set(
+                self.format_reader_name(name, code),
+                '%s %s' % (DOMAIN_NAME, PROCESS_ID),
+                time=self.shared_expire)
+            if len(self.get_readers_codes(shared_name)) >= 100:
+                self.get_alive_readers_codes(name)
+            if not self.memcache.append(shared_name, ' %s' % code):
+                self.memcache.set(shared_name, code)
+
+            with self.thread_lock:
+                self.shared_codes[name].append(code)
+            self.unlock(name)
+            return None
+
+        self.wait_for_readers(name, timeout, expire_time, delete_lock_on_timeout)
+
+    def wait_for_readers(self, name, timeout, expire_time, delete_lock_on_timeout=MARKER):
+        shared_name = self.format_shared_name(name)
+        while self.get_alive_readers_codes(name):
+            if expire_time and NOW_TIME() > expire_time:
+                if delete_lock_on_timeout is MARKER:
+                    delete_lock_on_timeout = self.delete_lock_on_timeout
+                if delete_lock_on_timeout:
+                    self.memcache.delete(shared_name)
+                    return None
+
+                self.unlock(name)
+                message = 'Timeout (%ss) on lock "%s" waiting for shared locks. Delete (%s) to unlock' % (
+                    timeout, name, shared_name)
+                raise LockTimeout(message, shared_name)
+
+            sleep(0.1)
+
+    def get_readers_codes(self, shared_name):
+        return to_string(self.memcache.get(shared_name) or '').split()
+
+    def get_alive_readers_codes(self, name):
+        # Called with the wait list locked, readers list is only changed there
+        shared_name = self.format_shared_name(name)
+        codes = self.get_readers_codes(shared_name)
+        if not codes:
+            return []
+
+        readers_names = dict((self.format_reader_name(name, code), code) for code in codes)
+        alive_codes = [
+            readers_names[reader_name]
+            for reader_name in self.memcache.get_multi(list(readers_names.keys()))]
+        if not alive_codes:
+            self.memcache.delete(shared_name)
+        elif len(alive_codes) < len(codes):
+            self.memcache.set(shared_name, ' '.join(alive_codes))
+        return alive_codes
+
+    def lock_wait_list(self, name, timeout=MARKER, delete_lock_on_timeout=MARKER):
         name_256 = self.format_name(name)
         lock_code = make_uuid_hash()
         lock_name = '%s %s %s' % (DOMAIN_NAME, PROCESS_ID, lock_code)
@@ -264,19 +769,126 @@ class LockMeMemcached(object):
                 if delete_lock_on_timeout:
                     self.unlock(name)
                     # Sorry, you need to do everything again
-                    return self.lock(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+                    return self.lock_wait_list(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
                 else:
                     # Clean invalid locks!
                     if self.clean_junk_locks(name_256):
                         # Go again
-                        return self.lock(name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+                        return self.lock_wait_list(
+                            name,
+                            timeout=timeout,
+                            delete_lock_on_timeout=delete_lock_on_timeout)
 
                     message = 'Timeout (%ss) on lock "%s". Delete (%s*) to unlock' % (timeout, name, name_256)
                     raise LockTimeout(message, name_256)
 
         self.memcache.delete(position_name_256)
 
-    def unlock(self, name):
+    def lock_many(self, names, timeout=MARKER, delete_lock_on_timeout=MARKER, shared=False):
+        add_multi = getattr(self.memcache, 'add_multi', None)
+        if shared or add_multi is None:
+            return super(LockMeMemcached, self).lock_many(
+                names,
+                timeout=timeout,
+                delete_lock_on_timeout=delete_lock_on_timeout,
+                shared=shared)
+
+        names = sorted(set(names))
+        if timeout is MARKER:
+            timeout = self.timeout
+        expire_time = timeout and (NOW_TIME() + int(timeout)) or None
+
+        locked_names = []
+        readers_names = []
+        try:
+            while names:
+                # Free locks are taken together, as first position of their wait list
+                names_256 = [self.format_name(name) for name in names]
+                not_added = set(add_multi(dict((name_256, '1') for name_256 in names_256)))
+
+                # Keep sorted order, names after a busy one are locked after it
+                added_names = []
+                busy_name = None
+                for name, name_256 in zip(names, names_256):
+                    if busy_name is not None:
+                        if name_256 not in not_added:
+                            added_names.append(name)
+                    elif name_256 in not_added:
+                        busy_name = name
+                    else:
+                        readers_names.append(name)
+
+                if added_names:
+                    self.unlock_many(added_names)
+
+                # Writers wait for readers
+                if readers_names:
+                    shared_names = dict((self.format_shared_name(name), name) for name in readers_names)
+                    with_readers = set(
+                        shared_names[shared_name]
+                        for shared_name in self.memcache.get_multi(list(shared_names.keys())))
+                    while readers_names:
+                        name = readers_names.pop(0)
+                        if name in with_readers:
+                            self.wait_for_readers(name, timeout, expire_time, delete_lock_on_timeout)
+                        locked_names.append(name)
+
+                if busy_name is None:
+                    break
+
+                if expire_time:
+                    timeout = max(expire_time - NOW_TIME(), 1)
+                self.lock(busy_name, timeout=timeout, delete_lock_on_timeout=delete_lock_on_timeout)
+                locked_names.append(busy_name)
+                names = names[names.index(busy_name) + 1:]
+        except:
+            self.unlock_many(locked_names + readers_names)
+            raise
+
+    def pop_shared_code(self, name):
+        with self.thread_lock:
+            codes = self.shared_codes.get(name)
+            if not codes:
+                return None
+
+            code = codes.pop(0)
+            if not codes:
+                self.shared_codes.pop(name)
+            return code
+
+    def unlock_many(self, names, shared=False):
+        if shared:
+            # Readers keys are deleted together
+            readers_names = []
+            for name in set(names):
+                code = self.pop_shared_code(name)
+                if code is not None:
+                    readers_names.append(self.format_reader_name(name, code))
+            if readers_names:
+                self.memcache.delete_multi(readers_names)
+            return None
+
+        # Locks without waiters are deleted together
+        names_256 = dict((self.format_name(name), name) for name in set(names))
+        last_positions = self.memcache.get_multi(list(names_256.keys()))
+
+        to_delete = []
+        for name_256, name in names_256.items():
+            if (maybe_integer(last_positions.get(name_256)) or 0) > 1:
+                self.unlock(name)
+            else:
+                to_delete.append(name_256)
+
+        if to_delete:
+            self.memcache.delete_multi(to_delete)
+
+    def unlock(self, name, shared=False):
+        if shared:
+            code = self.pop_shared_code(name)
+            if code is None:
+                return False
+            return bool(self.memcache.delete(self.format_reader_name(name, code)))
+
         name_256 = self.format_name(name)
         last_position = maybe_integer(self.memcache.get(name_256))
         if last_position:
@@ -312,3 +924,14 @@ class LockMeMemcached(object):
             if not active_positions:
                 self.memcache.delete(name_256)
                 return True
+
+
+def is_dead_lock_code(binary):
+    info = to_string(binary).split()
+    if len(info) >= 2 and info[0] == DOMAIN_NAME and maybe_integer(info[1]):
+        try:
+            getpgid(int(info[1]))
+        except OSError as error:
+            if error.errno is errno.ESRCH:
+                return True
+    return False
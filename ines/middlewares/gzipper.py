@@ -2,10 +2,12 @@
 
 from io import BytesIO
 from gzip import compress as gzip_compress
+from zlib import compressobj, DEFLATED, MAX_WBITS
 
 from pyramid.decorator import reify
 
 from ines.middlewares import Middleware
+from ines.renderers import FileIterator
 
 
 class Gzip(Middleware):
@@ -39,7 +41,18 @@ class GzipMiddlewareSession(object):
 
         self.start_response = start_response
         app_iter = self.middleware.application(environ, self.gzip_start_response)
-        if app_iter is not None and self.compressible:
+        if self.compressible and is_file_app_iter(app_iter):
+            # Files are sent as they are, keeping wsgi.file_wrapper
+            start_response(self.status, self.headers, self.exc_info)
+            return app_iter
+
+        elif app_iter is not None and self.compressible:
+            if not self.in_headers('content-length'):
+                # Chunked response, compress while sending
+                self.headers.append(('content-encoding', 'gzip'))
+                start_response(self.status, self.headers, self.exc_info)
+                return self.iter_compressed(app_iter)
+
             binary = gzip_compress(b''.join(app_iter), self.middleware.compress_level)
             if hasattr(app_iter, 'close'):
                 app_iter.close()
@@ -53,6 +66,19 @@ class GzipMiddlewareSession(object):
 
         return app_iter
 
+    def iter_compressed(self, app_iter):
+        # Gzip header and trailer
+        compressor = compressobj(self.middleware.compress_level, DEFLATED, MAX_WBITS | 16)
+        try:
+            for binary in app_iter:
+                binary = compressor.compress(binary)
+                if binary:
+                    yield binary
+            yield compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
     @reify
     def buffer(self):
         return BytesIO()
@@ -90,7 +116,10 @@ class GzipMiddlewareSession(object):
 
     def gzip_start_response(self, status, headers, exc_info=None):
         self.headers = [(key.lower(), value) for key, value in headers]
-        if not self.in_headers('content-encoding'):
+        if (status.startswith('200')
+                and not self.in_headers('content-encoding')
+                and not self.in_headers('content-range')
+                and self.get_header('accept-ranges') in (None, 'none')):
             content_type = self.get_header('content-type')
             if content_type and 'zip' not in content_type:
                 content_type = content_type.split(';')[0]
@@ -109,3 +138,8 @@ class GzipMiddlewareSession(object):
                     return self.buffer.write
 
         return self.start_response(status, headers, exc_info)
+
+
+def is_file_app_iter(app_iter):
+    # wsgi.file_wrapper implementations keep the file as "filelike"
+    return isinstance(app_iter, FileIterator) or hasattr(app_iter, 'filelike')
@@ -14,10 +14,12 @@ from ines import DEFAULT_RENDERERS
 from ines.convert import camelcase, encode_and_decode, maybe_string, to_string
 from ines.exceptions import Error
 from ines.i18n import _
+from ines.utils import is_stream
 
 
 DATE = datetime.date
 DATETIME = datetime.datetime
+FILE_BLOCK_SIZE = 2 ** 18
 
 
 # Compact JSON response
@@ -92,6 +94,48 @@ class CSV(object):
             rows.append(self.lookup_row(request, node, value))
         return rows
 
+    def iter_rows(self, request, node, values):
+        yield self.lookup_header(node, ())
+        for value in values:
+            yield self.lookup_row(request, node, value)
+
+    def has_sequence(self, node):
+        if isinstance(node.typ, Sequence):
+            return True
+        return any(self.has_sequence(child) for child in node.children)
+
+    def format_row(self, value_items, yes_text, no_text):
+        row = []
+        for item in value_items:
+            if item is None:
+                item = ''
+            elif not isinstance(item, str):
+                if isinstance(item, bool):
+                    item = item and yes_text or no_text
+                elif isinstance(item, (float, int)):
+                    item = str(item)
+                elif isinstance(item, (DATE, DATETIME)):
+                    item = item.isoformat()
+                elif not isinstance(item, str):
+                    item = to_string(item)
+            row.append(item)
+        return row
+
+    def iter_blocks(self, rows, yes_text, no_text, block_size=FILE_BLOCK_SIZE, **csv_options):
+        f = StringIO()
+        csvfile = csv_writer(f, **csv_options)
+        for value_items in rows:
+            csvfile.writerow(self.format_row(value_items, yes_text, no_text))
+            if f.tell() >= block_size:
+                yield f.getvalue()
+                f.seek(0)
+                f.truncate()
+
+        block = f.getvalue()
+        f.close()
+        if block:
+            yield block
+
     def build_with_schema(self, request, schema, values):
         pass
 
@@ -123,7 +167,14 @@ class CSV(object):
                     output_schema = output[0].schema
 
                 if output_schema:
-                    value = self.lookup_rows(request, output_schema.children[0], value)
+                    node = output_schema.children[0]
+                    if not is_stream(value):
+                        value = self.lookup_rows(request, node, value)
+                    elif self.has_sequence(node):
+                        # Sequence columns size is defined by all values
+                        value = self.lookup_rows(request, node, list(value))
+                    else:
+                        value = self.iter_rows(request, node, value)
 
                     output_filename = getattr(output_schema, 'filename', None)
                     if output_filename:
@@ -182,38 +233,28 @@ class CSV(object):
                 yes_text = 'Yes'
                 no_text = 'No'
 
-            if not value:
+            stream = is_stream(value)
+            if not stream and not value:
                 return ''
 
-            f = StringIO()
-            csvfile = csv_writer(
-                f,
+            blocks = self.iter_blocks(
+                value,
+                yes_text,
+                no_text,
                 delimiter=delimiter,
                 quotechar=quote_char,
                 lineterminator=line_terminator,
                 quoting=quoting)
 
-            for value_items in value:
-                row = []
-                for item in value_items:
-                    if item is None:
-                        item = ''
-                    elif not isinstance(item, str):
-                        if isinstance(item, bool):
-                            item = item and yes_text or no_text
-                        elif isinstance(item, (float, int)):
-                            item = str(item)
-                        elif isinstance(item, (DATE, DATETIME)):
-                            item = item.isoformat()
-                        elif not isinstance(item, str):
-                            item = to_string(item)
-                    row.append(item)
-                csvfile.writerow(row)
-
-            f.seek(0)
-            response = f.read()
-            f.close()
+            if stream and request is not None:
+                # Chunked response, rows are written while sending
+                response = request.response
+                charset = encoder and encoder.name or response.charset
+                response.app_iter = (block.encode(charset) for block in blocks)
+                response.content_length = None
+                return None
 
+            response = ''.join(blocks)
             if encoder:
                 response = encoder.decode(encoder.encode(response)[0])[0]
             else:
@@ -232,12 +273,42 @@ class File(object):
     def __call__(self, info):
         def _render(value, system):
             f = value['file']
-            response = system['request'].response
-            response.app_iter = f
-            response.content_length = int(value['content_length'])
+            request = system['request']
+            response = request.response
+            content_length = int(value['content_length'])
+
             response.status = 200
             response.content_type = maybe_string(value.get('content_type'))
 
+            if value.get('etag'):
+                response.etag = value['etag']
+            if value.get('last_modified'):
+                response.last_modified = value['last_modified']
+
+            content_range = None
+            if hasattr(f, 'seek'):
+                response.accept_ranges = 'bytes'
+
+                # Partial content, only when If-Range matches our etag / last modified
+                if request.range is not None and response in request.if_range:
+                    content_range = request.range.range_for_length(content_length)
+                    if content_range is None:
+                        f.close()
+                        response.app_iter = []
+                        response.content_length = 0
+                        response.content_range = 'bytes */%s' % content_length
+                        response.status = 416
+
+            if content_range is not None:
+                start, stop = content_range
+                response.app_iter = FileIterator(f, start, stop)
+                response.content_length = stop - start
+                response.content_range = (start, stop, content_length)
+                response.status = 206
+            elif response.status_code == 200:
+                response.app_iter = make_file_app_iter(request, f)
+                response.content_length = content_length
+
             filename = value.get('filename') or basename(f.name)
             if value.get('is_attachment'):
                 content_disposition = 'attachment; filename="%s"' % filename
@@ -254,6 +325,66 @@ class File(object):
         return _render
 
 
+def make_file_app_iter(request, f, block_size=FILE_BLOCK_SIZE):
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        # Let the server send the file (sendfile) when we have a real file
+        if hasattr(f, 'get_single_file'):
+            single_file = f.get_single_file()
+            if single_file is not None:
+                return file_wrapper(single_file, block_size)
+
+        elif hasattr(f, 'fileno'):
+            try:
+                f.fileno()
+            except (IOError, OSError):
+                pass
+            else:
+                return file_wrapper(f, block_size)
+
+    return FileIterator(f, block_size=block_size)
+
+
+class FileIterator(object):
+    def __init__(self, open_file, start=0, stop=None, block_size=FILE_BLOCK_SIZE):
+        self.open_file = open_file
+        self.position = start
+        self.stop = stop
+        self.block_size = block_size
+        if start:
+            self.open_file.seek(start)
+
+        # Read into the same buffer, every time
+        self.readinto = getattr(open_file, 'readinto', None)
+        if self.readinto is not None:
+            self.buffer = memoryview(bytearray(block_size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.block_size
+        if self.stop is not None:
+            size = min(size, self.stop - self.position)
+            if size <= 0:
+                raise StopIteration
+
+        if self.readinto is not None:
+            length = self.readinto(self.buffer[:size])
+            binary = length and bytes(self.buffer[:length])
+        else:
+            binary = self.open_file.read(size)
+
+        if not binary:
+            raise StopIteration
+
+        self.position += len(binary)
+        return binary
+
+    def close(self):
+        self.open_file.close()
+
+
 file_renderer_factory = File()  # bw compat
 DEFAULT_RENDERERS['file'] = file_renderer_factory
 
@@ -12,6 +12,7 @@ from ines import lazy_import_module
 PROCESS_RUNNING = set()
 KILLED_PROCESS = set()
 ALIVE_THREADS = defaultdict(dict)
+AFTER_FORK_METHODS = []
 
 
 def while_system_running_factory():
@@ -112,6 +113,16 @@ def register_thread(name, thread):
         ALIVE_THREADS[process_id][name] = thread
 
 
+def register_after_fork(method):
+    if method not in AFTER_FORK_METHODS:
+        AFTER_FORK_METHODS.append(method)
+
+
+def run_after_fork_methods():
+    for method in AFTER_FORK_METHODS:
+        method()
+
+
 # Register on python default
 atexit.register(exit_system)
 
@@ -125,4 +136,5 @@ else:
     def after_fork():
         PROCESS_RUNNING.add(getpid())
         uwsgi.atexit = exit_system
+        run_after_fork_methods()
     uwsgi.post_fork_hook = after_fork
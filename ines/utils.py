@@ -2,6 +2,7 @@
 
 from calendar import monthrange
 from collections import defaultdict
+from collections.abc import Iterator
 import datetime
 import errno
 from functools import wraps
@@ -39,6 +40,10 @@ DATE = datetime.date
 TIMEDELTA = datetime.timedelta
 PROCESS_ID = getpid()
 
+# Gear hash values, never change them or we lose deduplication of saved blocks
+GEAR_HASHES = tuple(int.from_bytes(sha256(bytes((i, ))).digest()[:8], 'big') for i in range(256))
+GEAR_HASH_MASK = 2 ** 64 - 1
+
 # See: http://www.regular-expressions.info/email.html
 EMAIL_REGEX = REGEX.compile(
     "[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
@@ -186,6 +191,24 @@ def file_modified_time(path, retries=3, retry_errno=DEFAULT_RETRY_ERRNO):
         return modified_time
 
 
+def file_stat(path, retries=3, retry_errno=DEFAULT_RETRY_ERRNO):
+    try:
+        stat = os_stat(path)
+    except OSError as error:
+        if error.errno is errno.ENOENT:
+            return None
+        elif error.errno in retry_errno:
+            # Try again, or not!
+            retries -= 1
+            if retries:
+                return file_stat(path, retries=retries, retry_errno=retry_errno)
+
+        # Something goes wrong
+        raise
+    else:
+        return stat
+
+
 def validate_email(value):
     return bool(EMAIL_REGEX.match(value))
 
@@ -526,6 +549,99 @@ def string_unique_code(value):
     return sha256(to_bytes(value)).hexdigest()
 
 
+def iter_binary_blocks(binary, block_size=OPEN_BLOCK_SIZE):
+    if isinstance(binary, (bytes, bytearray, str)):
+        # Slice a view, so we don't copy the remaining binary on every block
+        if isinstance(binary, str):
+            binary = to_bytes(binary)
+        view = memoryview(binary)
+        for start in range(0, len(view), block_size):
+            yield view[start:start + block_size].tobytes()
+        return None
+
+    if hasattr(binary, 'read'):
+        if hasattr(binary, 'seek'):
+            try:
+                binary.seek(0)
+            except (IOError, OSError, ValueError):
+                # Not seekable, like wsgi.input
+                pass
+        chunks = iter_file_chunks(binary, block_size)
+    else:
+        chunks = binary
+
+    # Streams can return less than asked, join chunks so blocks are always the same
+    buffered = bytearray()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = to_bytes(chunk)
+        buffered.extend(chunk)
+        while len(buffered) >= block_size:
+            yield bytes(buffered[:block_size])
+            del buffered[:block_size]
+
+    if buffered:
+        yield bytes(buffered)
+
+
+def iter_content_defined_blocks(binary, min_size, avg_size, max_size):
+    """ Content defined chunking (FastCDC), same content means same blocks
+    even when bytes are added or removed before it.
+    """
+    bits = max(avg_size.bit_length() - 1, 2)
+    # Gear hash high bits depend on more bytes, so we use them as mask
+    hard_mask = ((1 << (bits + 1)) - 1) << (63 - bits)
+    easy_mask = ((1 << (bits - 1)) - 1) << (65 - bits)
+
+    buffered = bytearray()
+    for chunk in iter_binary_blocks(binary, max_size):
+        buffered.extend(chunk)
+        while len(buffered) >= max_size:
+            position = find_block_cut_point(buffered, min_size, avg_size, max_size, hard_mask, easy_mask)
+            yield bytes(buffered[:position])
+            del buffered[:position]
+
+    while buffered:
+        position = find_block_cut_point(buffered, min_size, avg_size, max_size, hard_mask, easy_mask)
+        yield bytes(buffered[:position])
+        del buffered[:position]
+
+
+def find_block_cut_point(binary, min_size, avg_size, max_size, hard_mask, easy_mask):
+    length = min(len(binary), max_size)
+    if length <= min_size:
+        return length
+
+    gear_hashes = GEAR_HASHES
+    gear_hash_mask = GEAR_HASH_MASK
+    gear_hash = 0
+    position = min_size
+    normal_size = min(avg_size, length)
+
+    # Before the average size is harder to cut, after is easier
+    for byte in binary[position:normal_size]:
+        gear_hash = ((gear_hash << 1) + gear_hashes[byte]) & gear_hash_mask
+        position += 1
+        if not gear_hash & hard_mask:
+            return position
+
+    for byte in binary[position:length]:
+        gear_hash = ((gear_hash << 1) + gear_hashes[byte]) & gear_hash_mask
+        position += 1
+        if not gear_hash & easy_mask:
+            return position
+
+    return length
+
+
+def iter_file_chunks(open_file, block_size=OPEN_BLOCK_SIZE):
+    while True:
+        chunk = open_file.read(block_size)
+        if not chunk:
+            break
+        yield chunk
+
+
 def validate_skype_username(username, validate_with_api=False):
     if username:
         username = to_string(username)
@@ -602,6 +718,10 @@ def is_file_type(value):
     return isinstance(value, IOBase)
 
 
+def is_stream(values):
+    return isinstance(values, Iterator) or getattr(values, 'is_stream', False)
+
+
 def sort_with_none(iterable, key, reverse=False):
     def sort_key(item):
         value = getattr(item, key)
@@ -34,6 +34,8 @@ class DefaultAPIView(DefaultView):
             'last_page': pagination.last_page,
             'number_of_results': pagination.number_of_results,
             'number_of_page_results': pagination.number_of_page_results,
+            'number_of_results_is_estimate': getattr(pagination, 'number_of_results_is_estimate', False),
+            'next_cursor': getattr(pagination, 'next_cursor', None),
             values_key: pagination}
         result.update(self.create_pagination_href(route_name, pagination, **params))
         return result
@@ -45,10 +47,21 @@ class DefaultAPIView(DefaultView):
             if values:
                 queries[key] = values
 
+        # Page number is not used with keyset pagination
+        is_keyset = getattr(pagination, 'keyset', False)
+        queries.pop('cursor', None)
+
         # Next page
         next_href = None
         next_page = pagination.page + 1
-        if next_page <= pagination.last_page:
+        if is_keyset:
+            next_cursor = getattr(pagination, 'next_cursor', None)
+            if next_cursor:
+                next_href = self.request.route_url(
+                    route_name,
+                    _query=dict(queries, cursor=[next_cursor]),
+                    **params)
+        elif next_page <= pagination.last_page:
             queries['page'] = [next_page]
             next_href = self.request.route_url(
                 route_name,
@@ -58,7 +71,7 @@ class DefaultAPIView(DefaultView):
         # Previous page
         previous_href = None
         previous_page = pagination.page - 1
-        if previous_page >= 1:
+        if not is_keyset and previous_page >= 1:
             queries['page'] = [previous_page]
             previous_href = self.request.route_url(
                 route_name,
@@ -73,11 +86,13 @@ class DefaultAPIView(DefaultView):
             **params)
 
         # Last page
-        queries['page'] = [pagination.last_page]
-        last_href = self.request.route_url(
-            route_name,
-            _query=queries,
-            **params)
+        last_href = None
+        if not is_keyset:
+            queries['page'] = [pagination.last_page]
+            last_href = self.request.route_url(
+                route_name,
+                _query=queries,
+                **params)
 
         return {
             'next_page_href': next_href,
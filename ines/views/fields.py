@@ -386,9 +386,12 @@ class LimitPerPageInteger(Integer):
 
 PAGE = SchemaNode(Integer(), title=_('Page'), missing=1)
 LIMIT_PER_PAGE = SchemaNode(LimitPerPageInteger(), title=_('Results per page'), missing=20)
+CURSOR = SchemaNode(String(), title=_('Cursor'), name='cursor')
+NEXT_CURSOR = SchemaNode(String(), title=_('Next page cursor'), name='next_cursor')
 ORDER_BY = SchemaNode(String(), title=_('Order by'), name='order_by')
 NUMBER_OF_RESULTS = SchemaNode(Integer(), title=_('Number of results'))
 NUMBER_OF_PAGE_RESULTS = SchemaNode(Integer(), title=_('Number of page results'))
+NUMBER_OF_RESULTS_IS_ESTIMATE = SchemaNode(Boolean(), title=_('Number of results is an estimate'))
 LAST_PAGE = SchemaNode(Integer(), title=_('Last page'))
 NEXT_PAGE_HREF = SchemaNode(String(), title=_('Next page url'))
 PREVIOUS_PAGE_HREF = SchemaNode(String(), title=_('Previous page url'))
@@ -404,6 +407,7 @@ class OrderByInput(MappingSchema):
 class PaginationInput(OrderByInput):
     page = PAGE.clone(missing=1)
     limit_per_page = LIMIT_PER_PAGE
+    cursor = CURSOR.clone(missing=drop)
 
 
 CSV_DELIMITER = {
@@ -459,6 +463,8 @@ class PaginationOutput(MappingSchema):
     last_page = LAST_PAGE
     number_of_results = NUMBER_OF_RESULTS
     number_of_page_results = NUMBER_OF_PAGE_RESULTS
+    number_of_results_is_estimate = NUMBER_OF_RESULTS_IS_ESTIMATE
+    next_cursor = NEXT_CURSOR
     next_page_href = NEXT_PAGE_HREF
     previous_page_href = PREVIOUS_PAGE_HREF
     first_page_href = FIRST_PAGE_HREF
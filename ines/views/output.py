@@ -10,12 +10,13 @@ from zope.interface import implementer
 from ines.convert import camelcase
 from ines.exceptions import Error
 from ines.interfaces import IOutputSchemaView
-from ines.utils import different_values
+from ines.utils import different_values, is_stream
 
 
 @implementer(IOutputSchemaView)
 class OutputSchemaView(object):
     schema_type = 'response'
+    stream_renderers = ('csv', )
 
     def __init__(self, route_name, request_method, renderer, schema):
         self.route_name = route_name
@@ -135,6 +136,10 @@ class OutputSchemaView(object):
                 return []
 
             child = schema.children[0]
+            if self.renderer in self.stream_renderers and is_stream(values):
+                # Rows are built while the renderer writes the response
+                return self.iter_structure(child, values, fields)
+
             for value in values:
                 child_value = self.construct_structure(child, value, fields)
                 if child_value is not None:
@@ -195,6 +200,12 @@ class OutputSchemaView(object):
             else:
                 return values
 
+    def iter_structure(self, schema, values, fields):
+        for value in values:
+            value = self.construct_structure(schema, value, fields)
+            if value is not None:
+                yield value
+
     def allowed_fields_to_set(self, fields, padding=None):
         result = set()
         for key, children in fields.items():